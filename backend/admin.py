@@ -1,9 +1,10 @@
 from django.contrib import admin
 
-from backend.models import Visit, Photo, Place, Tag, UserProfile
+from backend.models import Visit, Photo, Place, Tag, UserProfile, Job
 
 admin.site.register(UserProfile)
 admin.site.register(Tag)
 admin.site.register(Place)
 admin.site.register(Photo)
 admin.site.register(Visit)
+admin.site.register(Job)
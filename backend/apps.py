@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+
+
+class BackendConfig(AppConfig):
+    name = 'backend'
+
+    def ready(self):
+        # Connect the signal handlers maintaining derived data and invalidating caches
+        import backend.authentication
+        import backend.clusters
+        import backend.conditional
+        import backend.feed
+        import backend.photo_cache
+        import backend.search
+        import backend.sync
+        import backend.tags
+        import backend.tasks
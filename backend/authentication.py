@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+class TokenCache(object):
+    """
+    Remembers token key -> (some user fields, token fields) for up to TOKEN_CACHE_TTL seconds.
+
+    The entries are kept in this process, at most TOKEN_CACHE_MAX_SIZE of them, unless TOKEN_CACHE_ALIAS names
+    a Django cache to share them through. Either way they're removed when the token or its user changes, which
+    only reaches the other processes with a shared cache, otherwise they notice after the TTL.
+    """
+
+    key_prefix = 'token-auth:'
+
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> (expiry time, entry), least recently used first
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'TOKEN_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def get(self, key):
+        if self.shared is not None:
+            entry = self.shared.get(self.key_prefix + key)
+        else:
+            with self.lock:
+                expires, entry = self.entries.pop(key, (0, None))
+                if expires > time.time():
+                    self.entries[key] = (expires, entry)
+                else:
+                    entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def set(self, key, entry):
+        ttl = getattr(settings, 'TOKEN_CACHE_TTL', 300)
+        if self.shared is not None:
+            self.shared.set(self.key_prefix + key, entry, ttl)
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, entry)
+            while len(self.entries) > getattr(settings, 'TOKEN_CACHE_MAX_SIZE', 10000):
+                self.entries.popitem(last=False)
+
+    def delete(self, keys):
+        if self.shared is not None:
+            self.shared.delete_many([self.key_prefix + key for key in keys])
+            return
+
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+token_cache = TokenCache()
+
+
+# Only what authentication needs is cached, never the password hash, the other fields are loaded when used
+CACHED_USER_FIELDS = ('id', 'username', 'is_active')
+
+
+def model_fields(instance, names=None):
+    if names is None:
+        names = [field.attname for field in instance._meta.concrete_fields]
+    return dict((name, getattr(instance, name)) for name in names)
+
+
+def from_fields(model, fields):
+    # Fields that aren't given are deferred, from_db() takes the others in the order of the model
+    names = [field.attname for field in model._meta.concrete_fields if field.attname in fields]
+    return model.from_db(DEFAULT_DB_ALIAS, names, [fields[name] for name in names])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication which doesn't query the database on every request, see TokenCache
+    """
+
+    def authenticate_credentials(self, key):
+        entry = token_cache.get(key)
+        if entry is None:
+            user, token = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+            token_cache.set(key, (model_fields(user, CACHED_USER_FIELDS), model_fields(token)))
+            return user, token
+
+        # Every request gets its own instances, the cached ones are never handed out
+        user_fields, token_fields = entry
+        user, token = from_fields(User, user_fields), from_fields(Token, token_fields)
+        # Checked like on a miss, whatever put the entry in the cache
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        token.user = user
+        return user, token
+
+
+def token_changed(sender, instance, **kwargs):
+    token_cache.delete([instance.key])
+
+
+def user_changed(sender, instance, **kwargs):
+    # Deleting a user deletes the tokens, which takes care of itself
+    token_cache.delete(list(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True)))
+
+post_save.connect(token_changed, sender=Token)
+post_delete.connect(token_changed, sender=Token)
+post_save.connect(user_changed, sender=User)
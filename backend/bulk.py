@@ -0,0 +1,46 @@
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max
+
+from backend.clusters import add_places
+from backend.feed import refresh_place_feeds
+from backend.models import Place
+from backend.search import get_search_backend
+from backend.tags import PlaceTag, tag_snapshot, update_tag_counts
+
+
+def bulk_create_places(places, place_tags):
+    """
+    Inserts unsaved places and their tags (a list of Tag lists, one for each place) with a few queries.
+
+    bulk_create() doesn't send any signals, so the clusters, tag counts, feeds and the search index are updated
+    here instead of by their signal handlers.
+    """
+    if not places:
+        return places
+
+    with transaction.atomic():
+        last_id = None
+        if not connection.features.can_return_ids_from_bulk_insert:
+            last_id = Place.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+        Place.objects.bulk_create(places)
+
+        if last_id is not None:
+            # SQLite assigns the ids in the order of insertion, and a concurrent insert between reading the last id
+            # and our insert makes one of the transactions fail rather than interleave
+            ids = list(Place.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True))
+            if len(ids) != len(places):
+                raise DatabaseError('Could not determine the ids of the inserted places')
+            for place, pk in zip(places, ids):
+                place.pk = pk
+
+        PlaceTag.objects.bulk_create([
+            PlaceTag(place_id=place.pk, tag_id=tag.pk) for place, tags in zip(places, place_tags) for tag in set(tags)
+        ])
+
+        place_ids = [place.pk for place in places]
+        add_places([(place.pk, place.coords.y, place.coords.x) for place in places])
+        update_tag_counts(dict((place_id, (set(), set())) for place_id in place_ids), tag_snapshot(place_ids))
+        refresh_place_feeds(place_ids)
+        with connection.cursor() as cursor:
+            get_search_backend().index_places(cursor, [(place.pk, place.name, place.description) for place in places])
+    return places
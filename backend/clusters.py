@@ -0,0 +1,166 @@
+import math
+from functools import reduce
+from operator import or_
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from backend.filters import filter_in_bbox, split_bbox
+from backend.models import Place, PlaceCluster
+
+# Zoom levels are the usual web map tile zoom levels, each tile is split into CELLS_PER_TILE x CELLS_PER_TILE clusters
+MAX_CLUSTER_ZOOM = 16
+CELLS_PER_TILE = 4
+MAX_LAT = 85.0511287798
+
+
+def cell_for(lat, lng, zoom):
+    """
+    Returns the (x, y) grid cell containing the given point at the given zoom level
+    """
+    n = CELLS_PER_TILE << zoom
+    lat_rad = math.radians(max(min(lat, MAX_LAT), -MAX_LAT))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def cell_bbox(zoom, x, y):
+    """
+    Returns the (min_lng, min_lat, max_lng, max_lat) box covered by a grid cell
+    """
+    n = float(CELLS_PER_TILE << zoom)
+
+    def lng(x):
+        return x / n * 360.0 - 180.0
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return lng(x), lat(y + 1), lng(x + 1), lat(y)
+
+
+def place_cells(lat, lng):
+    return [(zoom,) + cell_for(lat, lng, zoom) for zoom in range(MAX_CLUSTER_ZOOM + 1)]
+
+
+def cells_filter(cells):
+    return reduce(or_, [Q(zoom=zoom, x=x, y=y) for zoom, x, y in cells])
+
+
+def build_cells(places):
+    """
+    Aggregates (pk, lat, lng) tuples into a {(zoom, x, y): [count, lat_sum, lng_sum, representative pk]} dict
+    """
+    cells = {}
+    for pk, lat, lng in places:
+        for key in place_cells(lat, lng):
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [1, lat, lng, pk]
+            else:
+                cell[0] += 1
+                cell[1] += lat
+                cell[2] += lng
+    return cells
+
+
+def rebuild_clusters():
+    places = ((pk, coords.y, coords.x) for pk, coords in Place.objects.values_list('pk', 'coords').iterator())
+    cells = build_cells(places)
+    with transaction.atomic():
+        PlaceCluster.objects.all().delete()
+        PlaceCluster.objects.bulk_create([
+            PlaceCluster(zoom=zoom, x=x, y=y, count=count, lat_sum=lat_sum, lng_sum=lng_sum, place_id=place_id)
+            for (zoom, x, y), (count, lat_sum, lng_sum, place_id) in cells.items()
+        ], batch_size=500)
+    return len(cells)
+
+
+def add_place(place_id, lat, lng):
+    cells = place_cells(lat, lng)
+    with transaction.atomic():
+        PlaceCluster.objects.filter(cells_filter(cells)).update(
+            count=F('count') + 1, lat_sum=F('lat_sum') + lat, lng_sum=F('lng_sum') + lng)
+
+        existing = set(PlaceCluster.objects.filter(cells_filter(cells)).values_list('zoom', 'x', 'y'))
+        for zoom, x, y in cells:
+            if (zoom, x, y) in existing:
+                continue
+            try:
+                with transaction.atomic():
+                    PlaceCluster.objects.create(zoom=zoom, x=x, y=y, count=1, lat_sum=lat, lng_sum=lng, place_id=place_id)
+            except IntegrityError:
+                # Someone else has just created this cell
+                PlaceCluster.objects.filter(zoom=zoom, x=x, y=y).update(
+                    count=F('count') + 1, lat_sum=F('lat_sum') + lat, lng_sum=F('lng_sum') + lng)
+
+
+def add_places(places):
+    """
+    Same as add_place() for many (pk, lat, lng) tuples at once, with one update per affected cell
+    """
+    with transaction.atomic():
+        for (zoom, x, y), (count, lat_sum, lng_sum, place_id) in build_cells(places).items():
+            updates = {'count': F('count') + count, 'lat_sum': F('lat_sum') + lat_sum, 'lng_sum': F('lng_sum') + lng_sum}
+            if PlaceCluster.objects.filter(zoom=zoom, x=x, y=y).update(**updates):
+                continue
+            try:
+                with transaction.atomic():
+                    PlaceCluster.objects.create(zoom=zoom, x=x, y=y, count=count, lat_sum=lat_sum, lng_sum=lng_sum, place_id=place_id)
+            except IntegrityError:
+                # Someone else has just created this cell
+                PlaceCluster.objects.filter(zoom=zoom, x=x, y=y).update(**updates)
+
+
+def remove_place(place_id, lat, lng):
+    cells = PlaceCluster.objects.filter(cells_filter(place_cells(lat, lng)))
+    with transaction.atomic():
+        cells.update(count=F('count') - 1, lat_sum=F('lat_sum') - lat, lng_sum=F('lng_sum') - lng)
+        cells.filter(count__lte=0).delete()
+
+        # Find a new representative if it was this place
+        for cell in cells.filter(Q(place=None) | Q(place_id=place_id)):
+            candidates = filter_in_bbox(Place.objects.exclude(pk=place_id), cell_bbox(cell.zoom, cell.x, cell.y))
+            cell.place = candidates.order_by('pk').first()
+            cell.save(update_fields=['place'])
+
+
+def get_clusters(zoom, bbox=None):
+    """
+    Returns the non-empty cells at the given zoom level, optionally limited to a (west, south, east, north) box
+    """
+    zoom = min(max(zoom, 0), MAX_CLUSTER_ZOOM)
+    clusters = PlaceCluster.objects.filter(zoom=zoom)
+    if bbox is not None:
+        ranges = []
+        for west, south, east, north in split_bbox(bbox):
+            min_x, max_y = cell_for(south, west, zoom)
+            max_x, min_y = cell_for(north, east, zoom)
+            ranges.append(Q(x__range=(min_x, max_x), y__range=(min_y, max_y)))
+        clusters = clusters.filter(reduce(or_, ranges))
+    return clusters
+
+
+def remember_place_coords(sender, instance, **kwargs):
+    instance._cluster_coords = None
+    if instance.pk is not None:
+        instance._cluster_coords = Place.objects.filter(pk=instance.pk).values_list('coords', flat=True).first()
+
+
+def update_place_clusters(sender, instance, **kwargs):
+    old, new = instance._cluster_coords, instance.coords
+    if old is not None:
+        if (old.x, old.y) == (new.x, new.y):
+            return
+        remove_place(instance.pk, old.y, old.x)
+    add_place(instance.pk, new.y, new.x)
+
+
+def remove_place_clusters(sender, instance, **kwargs):
+    remove_place(instance.pk, instance.coords.y, instance.coords.x)
+
+pre_save.connect(remember_place_coords, sender=Place)
+post_save.connect(update_place_clusters, sender=Place)
+post_delete.connect(remove_place_clusters, sender=Place)
@@ -0,0 +1,189 @@
+import hashlib
+from calendar import timegm
+
+from django.contrib.auth.models import User
+from django.db.models import Count, Max
+from django.db.models.signals import pre_save, post_save, pre_delete, m2m_changed
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date, quote_etag
+
+from backend.models import Place, Photo, Tag, UserProfile
+from backend.serializers import query_param_set
+
+
+class ConditionalGetMixin(object):
+    """
+    Adds an ETag to the list and detail responses of a viewset, and Last-Modified to the detail ones, and answers
+    with 304 Not Modified when the client's copy is still current, before anything is serialized.
+
+    Lists don't get Last-Modified: the latest change of the objects in a list stays the same when some of them are
+    deleted or stop matching the filters, only their count in the ETag tells.
+
+    The validators are the latest last_modified_field and the number of the objects in the response, so that field
+    has to change whenever anything serialized does (see the signal handlers below). The ETag depends on the user
+    too, because some fields are different for each user, and on the format of the response.
+
+    Expanded fields (see SparseFieldsMixin) show other models, whose changes don't bump last_modified_field, so the
+    latest of their expanded_last_modified_fields is part of the validators too.
+    """
+
+    last_modified_field = 'date_modified'
+    # {expandable field name: lookup of the date_modified of the objects it shows}
+    expanded_last_modified_fields = {}
+
+    @property
+    def default_response_headers(self):
+        headers = super(ConditionalGetMixin, self).default_response_headers
+        # The responses, and so the ETags, depend on the user
+        headers['Vary'] = ', '.join(filter(None, [headers.get('Vary'), 'Authorization', 'Cookie']))
+        return headers
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(request, queryset, super(ConditionalGetMixin, self).list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+        except (ValueError, TypeError):
+            # An invalid lookup, get_object() responds with 404
+            return super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs)
+        etag, last_modified = self.get_validators(request, queryset)
+        return self.validated_response(request, etag, last_modified, super(ConditionalGetMixin, self).retrieve,
+                                       *args, **kwargs)
+
+    def get_validators(self, request, queryset):
+        """
+        Returns (ETag, Last-Modified timestamp) of the response listing the queryset
+        """
+        expanded = sorted(query_param_set(request, 'expand') & set(self.expanded_last_modified_fields))
+        aggregates = dict(('expanded_%s' % name, Max(self.expanded_last_modified_fields[name])) for name in expanded)
+        # The joins of the expanded fields repeat the objects
+        stats = queryset.order_by().aggregate(
+            last_modified=Max(self.last_modified_field), count=Count('pk', distinct=bool(expanded)), **aggregates)
+        if stats['last_modified'] is None:
+            return None, None
+
+        dates = [stats['last_modified']] + [stats['expanded_%s' % name] for name in expanded]
+        renderer = getattr(request, 'accepted_renderer', None)
+        etag = hashlib.md5(force_bytes('%s:%s:%s:%d' % (
+            getattr(renderer, 'format', ''), request.user.pk,
+            ','.join(date.isoformat() if date else '' for date in dates), stats['count']))).hexdigest()
+        return etag, timegm(max(date for date in dates if date).utctimetuple())
+
+    def conditional_response(self, request, queryset, view_func, *args, **kwargs):
+        """
+        Responds with view_func, or 304 Not Modified, to a request for a list of the queryset
+        """
+        etag, _ = self.get_validators(request, queryset)
+        return self.validated_response(request, etag, None, view_func, *args, **kwargs)
+
+    def validated_response(self, request, etag, last_modified, view_func, *args, **kwargs):
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view_func(request, *args, **kwargs)
+
+        if response.status_code in (200, 304) and etag is not None:
+            response['ETag'] = quote_etag(etag)
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+def touch_places(**filters):
+    Place.objects.filter(**filters).update(date_modified=timezone.now())
+
+
+def touch_profiles(**filters):
+    UserProfile.objects.filter(**filters).update(date_modified=timezone.now())
+
+
+def photo_changed(sender, instance, **kwargs):
+    touch_places(pk=instance.place_id)
+
+
+def changed_objects(instance, action, reverse, pk_set, related_name):
+    """
+    Returns filters matching the objects on the forward side of a changed m2m relation, or None
+    """
+    if action == 'pre_clear' and reverse:
+        # The related objects aren't known after they're cleared
+        return {related_name: instance}
+    if not action.startswith('post_') or action == 'post_clear' and reverse:
+        return None
+    if not reverse:
+        return {'pk': instance.pk}
+    return {'pk__in': pk_set}
+
+
+def place_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    filters = changed_objects(instance, action, reverse, pk_set, 'tags')
+    if filters is not None:
+        touch_places(**filters)
+
+
+def followed_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    filters = changed_objects(instance, action, reverse, pk_set, 'followed_tags')
+    if filters is not None:
+        touch_profiles(**filters)
+
+
+def saved_places_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    filters = changed_objects(instance, action, reverse, pk_set, 'saved_places')
+    if filters is not None:
+        touch_profiles(**filters)
+
+
+def remember_username(sender, instance, update_fields, **kwargs):
+    instance._old_username = instance.username
+    if instance.pk is not None and (update_fields is None or 'username' in update_fields):
+        instance._old_username = User.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+
+
+def user_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    touch_profiles(user=instance)
+    if instance._old_username != instance.username:
+        # Places show the username of the author
+        touch_places(author=instance)
+
+
+def remember_tag_name(sender, instance, **kwargs):
+    instance._old_name = None
+    if instance.pk is not None:
+        instance._old_name = Tag.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+
+def tag_renamed(sender, instance, created, **kwargs):
+    # Places, children and followers show the name of the tag
+    if created or instance._old_name == instance.name:
+        return
+    touch_places(tags=instance)
+    Tag.objects.filter(parent=instance).update(date_modified=timezone.now())
+    touch_profiles(followed_tags=instance)
+
+
+def tag_deleting(sender, instance, **kwargs):
+    # The relations are deleted along with the tag, without m2m_changed
+    touch_places(tags=instance)
+    touch_profiles(followed_tags=instance)
+
+
+def place_deleting(sender, instance, **kwargs):
+    touch_profiles(saved_places=instance)
+
+post_save.connect(photo_changed, sender=Photo)
+pre_delete.connect(photo_changed, sender=Photo)
+m2m_changed.connect(place_tags_changed, sender=Place.tags.through)
+m2m_changed.connect(followed_tags_changed, sender=UserProfile.followed_tags.through)
+m2m_changed.connect(saved_places_changed, sender=UserProfile.saved_places.through)
+pre_save.connect(remember_username, sender=User)
+post_save.connect(user_changed, sender=User)
+pre_save.connect(remember_tag_name, sender=Tag)
+post_save.connect(tag_renamed, sender=Tag)
+pre_delete.connect(tag_deleting, sender=Tag)
+pre_delete.connect(place_deleting, sender=Place)
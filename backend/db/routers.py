@@ -0,0 +1,195 @@
+import hashlib
+import itertools
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# The replica the current request reads from, or None for the primary, set by ReplicaMiddleware
+_state = threading.local()
+
+
+def client_key(request):
+    """
+    Identifies the client of a request by its credentials, before the authentication runs
+    """
+    credentials = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    return 'replica-pin:' + hashlib.md5(force_bytes(credentials)).hexdigest()
+
+
+def pin_cache():
+    return caches[settings.REPLICA_PIN_CACHE_ALIAS]
+
+
+class ReplicaMiddleware(object):
+    """
+    Lets the reads of safe requests go to one of the replicas, chosen once for the whole request so that all its
+    queries see the same data, see ReplicaRouter. Once a client writes, its requests read from the primary for
+    REPLICA_PIN_SECONDS, so that it always sees what it just wrote.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        key = client_key(request)
+        _state.replica = None
+        if settings.DATABASE_REPLICAS and request.method in SAFE_METHODS and not (key and pin_cache().get(key)):
+            _state.replica = choose_replica()
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = _state.wrote or request.method not in SAFE_METHODS
+            _state.replica = None
+        if wrote and key:
+            pin_cache().set(key, True, settings.REPLICA_PIN_SECONDS)
+        return response
+
+
+def reads_from_primary(func):
+    """
+    Makes the function read from the primary even in a request that reads from a replica, for reads which must
+    see every committed write, like the delta sync whose token comes from the primary's clock
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        replica = getattr(_state, 'replica', None)
+        _state.replica = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if not getattr(_state, 'wrote', False):
+                _state.replica = replica
+    return wrapper
+
+
+def beat():
+    """
+    Records a heartbeat on the primary, see LagMonitor
+    """
+    from backend.models import ReplicationHeartbeat
+
+    ReplicationHeartbeat.objects.using(DEFAULT_DB_ALIAS).update_or_create(pk=1, defaults={'date': timezone.now()})
+
+
+class LagMonitor(object):
+    """
+    Estimates how far behind the primary each replica is, by comparing the heartbeat the replication_heartbeat
+    command writes on the primary every REPLICA_HEARTBEAT_INTERVAL seconds with the copy on the replica. Without
+    a recent heartbeat on the primary nothing can be told and all replicas count as too far behind. The estimates
+    are refreshed every REPLICA_LAG_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.lags = {}  # alias -> (time checked, lag in seconds)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def heartbeat(alias):
+        from backend.models import ReplicationHeartbeat
+
+        return ReplicationHeartbeat.objects.using(alias).filter(pk=1).values_list('date', flat=True).first()
+
+    @staticmethod
+    def seconds(delta):
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+    def measure(self, aliases):
+        primary = self.heartbeat(DEFAULT_DB_ALIAS)
+        if primary is None or self.seconds(timezone.now() - primary) > 3 * settings.REPLICA_HEARTBEAT_INTERVAL:
+            # The heartbeat isn't running
+            return dict((alias, float('inf')) for alias in aliases)
+
+        lags = {}
+        for alias in aliases:
+            try:
+                replica = self.heartbeat(alias)
+            except Exception:
+                lags[alias] = float('inf')  # unreachable
+                continue
+            lags[alias] = float('inf') if replica is None else max(self.seconds(primary - replica), 0.0)
+        return lags
+
+    def get_lags(self, aliases):
+        now = time.time()
+        with self.lock:
+            stale = [alias for alias in aliases
+                     if now - self.lags.get(alias, (0, None))[0] >= settings.REPLICA_LAG_CHECK_INTERVAL]
+            if stale:
+                # Marked as checked first, so other threads don't measure the same replicas meanwhile
+                for alias in stale:
+                    self.lags[alias] = (now, self.lags.get(alias, (0, 0.0))[1])
+        if stale:
+            measured = self.measure(stale)
+            with self.lock:
+                for alias, lag in measured.items():
+                    self.lags[alias] = (now, lag)
+        with self.lock:
+            return dict((alias, self.lags[alias][1]) for alias in aliases)
+
+lag_monitor = LagMonitor()
+
+
+class ReplicaChooser(object):
+    """
+    Picks a replica by REPLICA_SELECTION: 'round-robin', or 'least-lag' which also skips replicas more than
+    REPLICA_MAX_LAG seconds behind, as measured by LagMonitor, returning None when there is no replica to use
+    """
+
+    def __init__(self):
+        self.replicas = None
+        self.cycle = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        if settings.REPLICA_SELECTION == 'least-lag':
+            lags = lag_monitor.get_lags(settings.DATABASE_REPLICAS)
+            alias, lag = min(lags.items(), key=lambda item: item[1])
+            return alias if lag <= settings.REPLICA_MAX_LAG else None
+        with self.lock:
+            if self.replicas != settings.DATABASE_REPLICAS:
+                self.replicas = list(settings.DATABASE_REPLICAS)
+                self.cycle = itertools.cycle(self.replicas)
+            return next(self.cycle)
+
+choose_replica = ReplicaChooser()
+
+
+class ReplicaRouter(object):
+    """
+    Sends the reads of safe requests to the replica ReplicaMiddleware chose for them. Everything else uses
+    the primary (default): writes, reads of other requests, of pinned clients, after a write in the same request,
+    in transactions and outside of requests, e.g. in management commands.
+
+    The replicas have to be copies of the primary kept up to date outside of Django, they have the same schema.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = getattr(_state, 'replica', None)
+        if replica is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        # The rest of the request reads what it wrote
+        _state.replica = None
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The primary and the replicas hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas get the schema with the data, from the primary
+        return db not in settings.DATABASE_REPLICAS
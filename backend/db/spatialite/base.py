@@ -0,0 +1,88 @@
+import logging
+import random
+import time
+
+from django.contrib.gis.db.backends.spatialite.base import DatabaseWrapper as SpatiaLiteDatabaseWrapper
+from django.db.backends.sqlite3.base import Database, SQLiteCursorWrapper
+
+logger = logging.getLogger(__name__)
+
+# Applied to every new connection, OPTIONS['pragmas'] overrides them. In WAL mode readers don't block the writer
+# and the other way round, and NORMAL is still safe there. busy_timeout (ms) makes SQLite wait for a lock instead
+# of failing right away.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+}
+# How many more times a write waits for the lock after busy_timeout runs out, OPTIONS['lock_retries']
+DEFAULT_LOCK_RETRIES = 5
+BACKOFF_BASE = 0.05
+
+
+def is_locked_error(e):
+    return 'locked' in str(e)
+
+
+class RetryingCursorWrapper(SQLiteCursorWrapper):
+    """
+    Retries statements failing because the database is locked, when they aren't part of a transaction
+    """
+
+    db = None
+
+    def execute(self, query, params=None):
+        return self.db.retry_when_locked(SQLiteCursorWrapper.execute, self, query, params)
+
+    def executemany(self, query, param_list):
+        return self.db.retry_when_locked(SQLiteCursorWrapper.executemany, self, query, param_list)
+
+
+class DatabaseWrapper(SpatiaLiteDatabaseWrapper):
+    """
+    SpatiaLite tuned for concurrent requests, see DEFAULT_PRAGMAS.
+
+    Transactions start with BEGIN IMMEDIATE, taking the write lock up front. A transaction which read first and
+    then tried to write would otherwise fail if another one wrote in the meantime, without waiting for the lock.
+    Starting a transaction and statements outside of one are retried with exponential backoff when the lock
+    isn't released within busy_timeout. Nothing has been done yet at that point, so that's always safe.
+
+    Use CONN_MAX_AGE to keep the connections, which saves loading SpatiaLite for every request.
+    """
+
+    def get_connection_params(self):
+        params = super(DatabaseWrapper, self).get_connection_params()
+        params.pop('pragmas', None)
+        params.pop('lock_retries', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super(DatabaseWrapper, self).get_new_connection(conn_params)
+        pragmas = dict(DEFAULT_PRAGMAS, **self.settings_dict['OPTIONS'].get('pragmas', {}))
+        for name, value in sorted(pragmas.items()):
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        return conn
+
+    def create_cursor(self):
+        cursor = self.connection.cursor(factory=RetryingCursorWrapper)
+        cursor.db = self
+        return cursor
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
+
+    def retry_when_locked(self, func, *args):
+        retries = self.settings_dict['OPTIONS'].get('lock_retries', DEFAULT_LOCK_RETRIES)
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except Database.OperationalError as e:
+                # Within a transaction the earlier statements would have to be repeated too
+                if not is_locked_error(e) or attempt >= retries or self.in_atomic_block:
+                    raise
+            attempt += 1
+            delay = BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning('Database locked, retrying in %.2f s (attempt %d of %d)' % (delay, attempt, retries))
+            time.sleep(delay)
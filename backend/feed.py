@@ -0,0 +1,165 @@
+from collections import defaultdict
+from datetime import datetime
+from functools import reduce
+from operator import or_
+
+from django.db.models.signals import pre_delete, post_delete, post_save, m2m_changed
+from django.utils import timezone
+
+from backend.models import FeedEntry, Place, Tag, UserProfile
+from backend.tags import PlaceTag, path_ids, subtree_filter, tag_snapshot
+
+FollowedTag = UserProfile.followed_tags.through
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Ratings are smoothed towards PRIOR_RATING as if every place had PRIOR_COUNT extra ratings, so that a single
+# four star visit doesn't beat a place rated by many people
+PRIOR_RATING = 2.0
+PRIOR_COUNT = 3
+# A star of the smoothed rating is worth as much as being this many days newer
+DAYS_PER_STAR = 7.0
+# A meter of distance costs as much as being this many days older, i.e. 10 km is a day
+DAYS_PER_METER = 0.0001
+
+BATCH_SIZE = 500
+
+
+def place_score(date_created, rating_sum, rating_count):
+    """
+    Returns the feed score of a place: its creation time in days, plus a bonus for the rating.
+
+    The score doesn't decay with time, newer places simply start higher, so it only changes with the rating.
+    """
+    days = (date_created - EPOCH).total_seconds() / 86400
+    rating = (rating_sum + PRIOR_RATING * PRIOR_COUNT) / (rating_count + PRIOR_COUNT)
+    return days + DAYS_PER_STAR * rating
+
+
+def place_scores(place_ids):
+    places = Place.objects.filter(pk__in=place_ids).values_list('pk', 'date_created', 'rating_sum', 'rating_count')
+    return dict((values[0], place_score(*values[1:])) for values in places)
+
+
+def add_entries(pairs):
+    """
+    Adds (user id, place id) pairs to the feeds
+    """
+    scores = place_scores(set(place_id for _, place_id in pairs))
+    FeedEntry.objects.bulk_create([
+        FeedEntry(user_id=user_id, place_id=place_id, score=scores[place_id])
+        for user_id, place_id in pairs if place_id in scores
+    ], batch_size=BATCH_SIZE)
+
+
+def refresh_place_feeds(place_ids):
+    """
+    Brings the feed entries of the given places in line with their tags and the followers of those tags
+    """
+    covers = dict((place_id, cover) for place_id, (_, cover) in tag_snapshot(place_ids).items())
+    tag_ids = set().union(*covers.values())
+    followers = FollowedTag.objects.filter(tag_id__in=tag_ids).values_list('userprofile__user_id', 'tag_id')
+
+    wanted = set()
+    for user_id, tag_id in followers:
+        wanted.update((user_id, place_id) for place_id, cover in covers.items() if tag_id in cover)
+    existing = set(FeedEntry.objects.filter(place_id__in=place_ids).values_list('user_id', 'place_id'))
+
+    removed = defaultdict(list)
+    for user_id, place_id in existing - wanted:
+        removed[place_id].append(user_id)
+    for place_id, user_ids in removed.items():
+        FeedEntry.objects.filter(place_id=place_id, user_id__in=user_ids).delete()
+    add_entries(wanted - existing)
+
+
+def refresh_user_feed(user_id):
+    """
+    Brings the feed of a user in line with the tags they follow
+    """
+    paths = Tag.objects.filter(followers__user_id=user_id).values_list('path', flat=True)
+    wanted = set()
+    if paths:
+        places = PlaceTag.objects.filter(reduce(or_, [subtree_filter(path, 'tag__path') for path in paths]))
+        wanted = set(places.values_list('place_id', flat=True).distinct())
+    existing = set(FeedEntry.objects.filter(user_id=user_id).values_list('place_id', flat=True))
+
+    removed = list(existing - wanted)
+    for i in range(0, len(removed), BATCH_SIZE):
+        FeedEntry.objects.filter(user_id=user_id, place_id__in=removed[i:i + BATCH_SIZE]).delete()
+    add_entries([(user_id, place_id) for place_id in wanted - existing])
+
+
+def update_place_score(place_id):
+    """
+    Has to be called when the rating of a place changes
+    """
+    for place_id, score in place_scores([place_id]).items():
+        FeedEntry.objects.filter(place_id=place_id).update(score=score)
+
+
+def rebuild_feeds():
+    FeedEntry.objects.all().delete()
+    user_ids = list(UserProfile.objects.filter(followed_tags__isnull=False).values_list('user_id', flat=True).distinct())
+    for user_id in user_ids:
+        refresh_user_feed(user_id)
+    return len(user_ids)
+
+
+def followers_of(tag_ids):
+    return set(FollowedTag.objects.filter(tag_id__in=tag_ids).values_list('userprofile__user_id', flat=True))
+
+
+def place_tags_changing(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # The places losing the tag aren't known afterwards
+        instance._feed_place_ids = list(PlaceTag.objects.filter(tag_id=instance.pk).values_list('place_id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            place_ids = [instance.pk]
+        elif action == 'post_clear':
+            place_ids = instance._feed_place_ids
+        else:
+            place_ids = list(pk_set)
+        if place_ids:
+            refresh_place_feeds(place_ids)
+
+
+def followed_tags_changing(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._feed_user_ids = list(FollowedTag.objects.filter(tag_id=instance.pk).values_list('userprofile__user_id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            user_ids = [instance.user_id]
+        elif action == 'post_clear':
+            user_ids = instance._feed_user_ids
+        else:
+            user_ids = UserProfile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True)
+        for user_id in user_ids:
+            refresh_user_feed(user_id)
+
+
+def tag_moved(sender, instance, created, **kwargs):
+    # backend.tags has updated the paths already, its handlers are connected first
+    old_path = getattr(instance, '_old_path', None)
+    if created or not old_path or old_path == instance.path:
+        return
+    subtree = Tag.objects.filter(subtree_filter(instance.path)).values_list('pk', flat=True)
+    for user_id in followers_of(set(path_ids(old_path) + path_ids(instance.path)) | set(subtree)):
+        refresh_user_feed(user_id)
+
+
+def tag_deleting(sender, instance, **kwargs):
+    # Followers of the ancestors can lose places which only had this tag
+    instance._feed_user_ids = followers_of(path_ids(instance.path))
+
+
+def tag_deleted(sender, instance, **kwargs):
+    for user_id in instance._feed_user_ids:
+        refresh_user_feed(user_id)
+
+post_save.connect(tag_moved, sender=Tag)
+pre_delete.connect(tag_deleting, sender=Tag)
+post_delete.connect(tag_deleted, sender=Tag)
+m2m_changed.connect(place_tags_changing, sender=PlaceTag)
+m2m_changed.connect(followed_tags_changing, sender=FollowedTag)
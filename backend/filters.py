@@ -0,0 +1,237 @@
+import math
+from functools import reduce
+from operator import or_
+
+from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.geos import Point, Polygon
+from django.db import connections
+from django.db.models import ExpressionWrapper, F, FloatField, Q
+from rest_framework import exceptions
+from rest_framework.filters import BaseFilterBackend
+
+from backend.feed import DAYS_PER_METER
+from backend.models import Tag
+from backend.search import get_search_backend, search_words
+from backend.tags import PlaceTag, subtree_filter
+
+# A degree of latitude is never shorter than this many meters, so boxes computed with it are never too small
+METERS_PER_DEGREE = 110000.0
+
+
+def parse_floats(request, param, count):
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+
+    try:
+        floats = [float(x) for x in value.split(',')]
+    except ValueError:
+        floats = []
+    if len(floats) != count:
+        raise exceptions.ParseError('%s should be %d comma separated numbers' % (param, count))
+    return floats
+
+
+def parse_bbox(request, param):
+    """
+    Parses a lat1,lng1,lat2,lng2 box, from its western corner eastwards to the other one, into
+    (west, south, east, north). When lng1 is greater than lng2 the box crosses the antimeridian, see split_bbox().
+    """
+    bbox = parse_floats(request, param, 4)
+    if bbox is None:
+        return None
+    lat1, lng1, lat2, lng2 = bbox
+    return lng1, min(lat1, lat2), lng2, max(lat1, lat2)
+
+
+def bbox_around(lat, lng, radius):
+    """
+    Returns the (west, south, east, north) box containing the circle of the given radius (in meters), which crosses
+    the antimeridian when the circle does
+    """
+    dlat = radius / METERS_PER_DEGREE
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat * 180 <= dlat:
+        dlng = 180
+    else:
+        dlng = dlat / cos_lat
+    south, north = max(lat - dlat, -90), min(lat + dlat, 90)
+    if dlng >= 180:
+        return -180, south, 180, north
+    west, east = lng - dlng, lng + dlng
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return west, south, east, north
+
+
+def split_bbox(bbox):
+    """
+    Returns the boxes making up a (west, south, east, north) box: itself, or the parts on both sides of the
+    antimeridian when west is greater than east
+    """
+    west, south, east, north = bbox
+    if west <= east:
+        return [bbox]
+    return [(west, south, 180, north), (-180, south, east, north)]
+
+
+def filter_in_bbox(queryset, bbox):
+    """
+    Limits the queryset to places within (west, south, east, north), using the spatial index on coords
+    """
+    opts = queryset.model._meta
+    boxes = split_bbox(bbox)
+    contained = []
+    for box in boxes:
+        polygon = Polygon.from_bbox(box)
+        polygon.srid = opts.get_field('coords').srid
+        contained.append(Q(coords__contained=polygon))
+    queryset = queryset.filter(reduce(or_, contained))
+
+    # SpatiaLite doesn't use its R*Tree index by itself, it has to be queried explicitly.
+    # PostGIS picks up the GiST index for the lookup above on its own.
+    if getattr(connections[queryset.db].ops, 'spatialite', False) and opts.get_field('coords').spatial_index:
+        index_table = 'idx_%s_%s' % (opts.db_table, opts.get_field('coords').column)
+        ranges = ' OR '.join(['(xmin >= %s AND xmax <= %s AND ymin >= %s AND ymax <= %s)'] * len(boxes))
+        queryset = queryset.extra(
+            where=['"%s"."%s" IN (SELECT pkid FROM "%s" WHERE %s)' % (opts.db_table, opts.pk.column, index_table, ranges)],
+            params=[value for box in boxes for value in (box[0], box[2], box[1], box[3])],
+        )
+    return queryset
+
+
+class CursorOrderingMixin(object):
+    """
+    For filters that sort the results. The cursor pagination takes its ordering from get_ordering() of the first
+    filter backend of the view that has one, and it has to match the order_by() of the queryset or the cursors would
+    skip and repeat results. So get_ordering() asks every filter backend of the view for the ordering it applies
+    (filter_ordering()), falling back to the ordering of the pagination when none of them sorts the results.
+    """
+
+    def filter_ordering(self, request):
+        """
+        Returns the ordering applied by filter_queryset(), if any
+        """
+        return None
+
+    def get_ordering(self, request, queryset, view):
+        for backend in view.filter_backends:
+            if issubclass(backend, CursorOrderingMixin):
+                ordering = backend().filter_ordering(request)
+                if ordering is not None:
+                    return ordering
+        return view.pagination_class.ordering
+
+
+class PlaceLocationFilter(CursorOrderingMixin, BaseFilterBackend):
+    """
+    Filters places by location. All coordinates are given as lat,lng, like everywhere else in the API.
+
+    * `?in_bbox=lat1,lng1,lat2,lng2` - only places inside the box from its western corner eastwards to the other one,
+      crossing the antimeridian when lng1 > lng2
+    * `?near=lat,lng&radius=meters` - only places within radius of the given point
+    * `?near=lat,lng&ordering=distance` - closest places first (can be combined with radius)
+    """
+
+    def filter_ordering(self, request):
+        if request.query_params.get('ordering') == 'distance':
+            return ('distance', 'id')
+        return None
+
+    def filter_queryset(self, request, queryset, view):
+        in_bbox = parse_bbox(request, 'in_bbox')
+        if in_bbox is not None:
+            queryset = filter_in_bbox(queryset, in_bbox)
+
+        near = parse_floats(request, 'near', 2)
+        radius = parse_floats(request, 'radius', 1)
+        order_by_distance = request.query_params.get('ordering') == 'distance'
+        if near is None:
+            if radius is not None or order_by_distance:
+                raise exceptions.ParseError('radius and ordering=distance require near')
+            return queryset
+
+        lat, lng = near
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise exceptions.ParseError('near is out of range')
+        point = Point(lng, lat, srid=4326)
+
+        if radius is not None:
+            radius = radius[0]
+            if radius < 0:
+                raise exceptions.ParseError('radius should not be negative')
+            queryset = filter_in_bbox(queryset, bbox_around(lat, lng, radius))
+
+        if radius is not None or order_by_distance:
+            queryset = queryset.annotate(distance=Distance('coords', point, spheroid=True))
+        if radius is not None:
+            queryset = queryset.filter(distance__lte=radius)
+        if order_by_distance:
+            queryset = queryset.order_by('distance', 'pk')
+        return queryset
+
+
+class PlaceSearchFilter(CursorOrderingMixin, BaseFilterBackend):
+    """
+    `?q=words` - only places with all the words (or words starting with them) in the name or description,
+    best matches first unless another ordering is given
+    """
+
+    def filter_ordering(self, request):
+        if search_words(request.query_params.get('q')) and 'ordering' not in request.query_params:
+            return ('search_rank', 'id')
+        return None
+
+    def filter_queryset(self, request, queryset, view):
+        words = search_words(request.query_params.get('q'))
+        if not words:
+            return queryset
+        queryset = get_search_backend().search(queryset, words)
+        if 'ordering' not in request.query_params:
+            queryset = queryset.order_by('search_rank', 'pk')
+        return queryset
+
+
+class PlaceTagFilter(CursorOrderingMixin, BaseFilterBackend):
+    """
+    `?tag=name` - only places with the tag or any of its descendants. When given multiple times, places have to match
+    all of them.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        names = request.query_params.getlist('tag')
+        if not names:
+            return queryset
+
+        paths = dict(Tag.objects.filter(name__in=names).values_list('name', 'path'))
+        for name in names:
+            if name not in paths:
+                return queryset.none()
+            queryset = queryset.filter(pk__in=PlaceTag.objects.filter(subtree_filter(paths[name], 'tag__path')).values('place_id'))
+        return queryset
+
+
+class FeedLocationFilter(CursorOrderingMixin, BaseFilterBackend):
+    """
+    `?near=lat,lng` - ranks the feed by distance from the given point too, every 10 km costs as much as a day of age
+    """
+
+    def filter_ordering(self, request):
+        if 'near' in request.query_params:
+            return ('-rank', '-id')
+        return None
+
+    def filter_queryset(self, request, queryset, view):
+        near = parse_floats(request, 'near', 2)
+        if near is None:
+            return queryset
+
+        lat, lng = near
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise exceptions.ParseError('near is out of range')
+        point = Point(lng, lat, srid=4326)
+
+        distance = Distance('place__coords', point, spheroid=True)
+        return queryset.annotate(rank=ExpressionWrapper(F('score') - distance * DAYS_PER_METER, output_field=FloatField()))
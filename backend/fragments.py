@@ -0,0 +1,64 @@
+import hashlib
+
+import six
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import prefetch_related_objects
+from django.utils.encoding import force_bytes
+from rest_framework.relations import HyperlinkedIdentityField
+
+
+def place_fragment_key(request, place, variant=''):
+    """
+    The representation of a place depends on the place, which bumps date_modified whenever something shown changes
+    (see backend.conditional), on the host the urls are built for and on the fields chosen by the client (variant)
+    """
+    base = hashlib.md5(force_bytes(request.build_absolute_uri('/') + variant)).hexdigest()[:8]
+    return 'place:%s:%d:%s' % (base, place.pk, place.date_modified.isoformat())
+
+
+def plain_links(representation, links):
+    representation = representation.copy()
+    for field in links:
+        representation[field.field_name] = six.text_type(representation[field.field_name])
+    return representation
+
+
+def place_representations(serializer, places):
+    """
+    Serializes places with PlaceSerializer, taking the parts shared by all users from the cache in a single get_many.
+    Only the places missing from the cache are fetched (see PlaceSerializer.get_prefetch_lookups) and serialized, the
+    visit of the current user is added to all of them afterwards.
+
+    Expanded fields show other models, whose changes don't bump the date_modified of the places, so representations
+    with any of them aren't cached.
+
+    The links to the place are cached as plain urls, pickling them would compute the names they carry for the
+    browsable API, and they're filled into their url templates again when read, which is cheap.
+    """
+    cache = caches[settings.PLACE_CACHE_ALIAS]
+    request = serializer.context['request']
+    names = [field.field_name for field in serializer._readable_fields]
+    links = [field for field in serializer._readable_fields if isinstance(field, HyperlinkedIdentityField)]
+    cached = not serializer.expanded_fields
+    keys = [place_fragment_key(request, place, ','.join(names)) for place in places]
+    fragments = cache.get_many(keys) if cached else {}
+
+    missing = [(place, key) for place, key in zip(places, keys) if key not in fragments]
+    if missing:
+        prefetch_related_objects([place for place, _ in missing], *serializer.get_prefetch_lookups())
+        fresh = dict((key, serializer.shared_representation(place)) for place, key in missing)
+        if cached:
+            cache.set_many(dict((key, plain_links(representation, links)) for key, representation in fresh.items()),
+                           settings.PLACE_CACHE_TIMEOUT)
+        fragments.update(fresh)
+
+    representations = []
+    for place, key in zip(places, keys):
+        representation = fragments[key].copy()
+        for field in links:
+            representation[field.field_name] = field.to_representation(place)
+        if 'visit' in names:
+            representation['visit'] = serializer.get_visit(place)
+        representations.append(representation)
+    return representations
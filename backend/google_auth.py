@@ -0,0 +1,162 @@
+import base64
+import binascii
+import json
+import logging
+import re
+import threading
+import time
+
+import six
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.encoding import force_bytes, force_text
+from django.utils.module_loading import import_string
+from requests import RequestException
+
+from backend.http_client import get_provider_client
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# Allowed difference between our clock and Google's
+CLOCK_SKEW = 60
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class KeysUnavailable(Exception):
+    """
+    The signing keys couldn't be fetched, so the token can't be checked locally
+    """
+    pass
+
+
+def b64decode(data):
+    data = force_bytes(data)
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def b64_to_int(data):
+    return int(binascii.hexlify(b64decode(data)), 16)
+
+
+def jwk_to_key(jwk):
+    return RSA.construct((b64_to_int(jwk['n']), b64_to_int(jwk['e'])))
+
+
+class GoogleKeySource(object):
+    """
+    Fetches Google's signing keys and keeps them for as long as the Cache-Control header of the response allows
+    """
+
+    # Tokens signed with a key we don't know make us fetch the keys again, but not more often than this
+    min_refresh_interval = 60
+
+    def __init__(self):
+        self.keys = {}
+        self.expires = 0
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, kid):
+        with self.lock:
+            now = time.time()
+            if now >= self.expires or (kid not in self.keys and now - self.fetched >= self.min_refresh_interval):
+                self.fetch_keys(now)
+            return self.keys.get(kid)
+
+    def fetch_keys(self, now):
+        try:
+            response = get_provider_client('google').request('get', GOOGLE_CERTS_URL)
+            keys = dict((jwk['kid'], jwk_to_key(jwk)) for jwk in response.json()['keys'] if jwk.get('kty') == 'RSA')
+        except (RequestException, ValueError, KeyError) as e:
+            if now < self.expires:
+                return  # the keys we have are still good
+            raise KeysUnavailable('Unable to fetch the signing keys: {0}'.format(e))
+
+        self.keys = keys
+        self.fetched = now
+        self.expires = now + self.max_age(response)
+
+    @staticmethod
+    def max_age(response):
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        return int(match.group(1)) if match else 0
+
+
+class StaticKeySource(object):
+    """
+    Serves a fixed set of keys, {kid: RSA key or its PEM}, e.g. for signing tokens locally in tests
+    """
+
+    def __init__(self, keys):
+        self.keys = dict((kid, RSA.importKey(key) if isinstance(key, six.string_types) else key)
+                         for kid, key in keys.items())
+
+    def get_key(self, kid):
+        return self.keys.get(kid)
+
+
+_key_source = None
+
+
+def get_key_source():
+    """
+    Returns the key source made by GOOGLE_KEY_SOURCE, the dotted path of a class or any other callable, called with
+    GOOGLE_KEY_SOURCE_OPTIONS as keyword arguments
+    """
+    global _key_source
+    if _key_source is None:
+        factory = import_string(getattr(settings, 'GOOGLE_KEY_SOURCE', 'backend.google_auth.GoogleKeySource'))
+        _key_source = factory(**getattr(settings, 'GOOGLE_KEY_SOURCE_OPTIONS', {}))
+    return _key_source
+
+
+def key_source_changed(setting, **kwargs):
+    global _key_source
+    if setting in ('GOOGLE_KEY_SOURCE', 'GOOGLE_KEY_SOURCE_OPTIONS'):
+        _key_source = None
+
+setting_changed.connect(key_source_changed)
+
+
+def verify_id_token(id_token, audience, key_source=None):
+    """
+    Checks the signature, issuer, audience and expiry of a Google ID token and returns its claims.
+
+    Raises InvalidToken if the token isn't valid and KeysUnavailable if that can't be determined.
+    """
+    try:
+        header, payload, signature = force_bytes(id_token).split(b'.')
+        header_data = json.loads(force_text(b64decode(header)))
+        claims = json.loads(force_text(b64decode(payload)))
+        signature = b64decode(signature)
+    except (ValueError, TypeError):
+        raise InvalidToken('Malformed token.')
+
+    if header_data.get('alg') != 'RS256':
+        raise InvalidToken('Unsupported signing algorithm.')
+    key = (key_source or get_key_source()).get_key(header_data.get('kid'))
+    if key is None:
+        raise InvalidToken('Unknown signing key.')
+    if not PKCS1_v1_5.new(key).verify(SHA256.new(header + b'.' + payload), signature):
+        raise InvalidToken('Invalid signature.')
+
+    if claims.get('iss') not in GOOGLE_ISSUERS:
+        raise InvalidToken('Invalid issuer.')
+    if claims.get('aud') != audience:
+        raise InvalidToken('This token is not meant for this app. %s != %s' % (claims.get('aud'), audience))
+    try:
+        expires = float(claims['exp'])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidToken('Invalid expiry time.')
+    if expires + CLOCK_SKEW < time.time():
+        raise InvalidToken('Token expired.')
+    return claims
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+
+import requests
+from allaccess.clients import OAuth2Client
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(requests.RequestException):
+    """
+    The provider failed too many times in a row, so it isn't even tried for a while
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failures. While open, calls fail right away, until `reset_timeout` seconds
+    pass and a single call is let through to see if the provider is back.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        return 'open' if time.time() < self.opened + self.reset_timeout else 'half-open'
+
+    def before_call(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.time() < self.opened + self.reset_timeout:
+                raise CircuitOpen('The provider is unavailable, try again later.')
+            # Let this call through, but keep the others out until it finishes
+            self.opened = time.time()
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+
+class ProviderStats(object):
+    def __init__(self):
+        self.requests = self.errors = 0
+        self.total_time = self.max_time = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, error):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'avg_ms': self.total_time * 1000 / self.requests if self.requests else None,
+                'max_ms': self.max_time * 1000,
+            }
+
+
+class ProviderClient(object):
+    """
+    Keeps the connections to a provider alive between requests, and bounds how long a request can take.
+
+    Connection errors and 502-504 responses of GET requests are retried. Every failed request counts towards
+    opening the circuit breaker.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.session = requests.Session()
+        retries = Retry(total=settings.OAUTH_HTTP_RETRIES, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(pool_maxsize=settings.OAUTH_HTTP_POOL_SIZE, max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.breaker = CircuitBreaker(settings.OAUTH_CIRCUIT_THRESHOLD, settings.OAUTH_CIRCUIT_RESET_TIMEOUT)
+        self.stats = ProviderStats()
+
+    def request(self, method, url, **kwargs):
+        self.breaker.before_call()
+        kwargs.setdefault('timeout', settings.OAUTH_HTTP_TIMEOUT)
+        start = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            # Client errors are about the request, e.g. an invalid token, not about the provider
+            provider_error = getattr(e, 'response', None) is None or e.response.status_code >= 500
+            self.stats.record(time.time() - start, provider_error)
+            if provider_error:
+                self.breaker.failed()
+                logger.warning('Request to %s failed: %s' % (self.name, e))
+            else:
+                self.breaker.succeeded()
+            raise
+        self.stats.record(time.time() - start, False)
+        self.breaker.succeeded()
+        return response
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_provider_client(name):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = ProviderClient(name)
+        return _clients[name]
+
+
+def provider_stats():
+    with _clients_lock:
+        clients = list(_clients.values())
+    return dict((client.name, dict(client.stats.as_dict(), circuit=client.breaker.state)) for client in clients)
+
+
+class PooledOAuth2Client(OAuth2Client):
+    """
+    OAuth2Client making its requests through the ProviderClient of the provider
+    """
+
+    def request(self, method, url, **kwargs):
+        token, _ = self.parse_raw_token(kwargs.pop('token', self.token))
+        if token is not None:
+            kwargs.setdefault('params', {})['access_token'] = token
+        return get_provider_client(self.provider.name).request(method, url, **kwargs)
@@ -0,0 +1,99 @@
+import logging
+import math
+
+from PIL import Image, ImageOps
+from django.core.files.base import ContentFile
+from six import BytesIO
+from stdimage.models import StdImageFieldFile
+
+logger = logging.getLogger(__name__)
+
+ORIENTATION_KEY = 274  # cf ExifTags
+
+ROTATE_VALUES = {
+    3: Image.ROTATE_180,
+    6: Image.ROTATE_270,
+    8: Image.ROTATE_90
+}
+
+
+def orientation_transpose(image):
+    """
+    Returns the transposition fixing the orientation stored in the EXIF data, or None. Doesn't decode the image.
+    """
+    if image.format != 'JPEG':
+        return None
+    exif = image._getexif()
+    if not exif or ORIENTATION_KEY not in exif:
+        return None
+    return ROTATE_VALUES.get(exif[ORIENTATION_KEY])
+
+
+def needs_resize(size, variation):
+    return size[0] > variation['width'] or size[1] > variation['height']
+
+
+def decoded_size(size, variation):
+    """
+    Returns the smallest size the image can be decoded at without making the variation any worse
+    """
+    if not needs_resize(size, variation):
+        return size
+    scales = [float(variation['width']) / size[0], float(variation['height']) / size[1]]
+    # A cropped variation covers the whole box, otherwise the image is fit inside it
+    scale = max(scales) if variation['crop'] else min(scales)
+    return int(math.ceil(size[0] * scale)), int(math.ceil(size[1] * scale))
+
+
+def resize(image, variation):
+    if not needs_resize(image.size, variation):
+        return image
+    size = tuple(int(i) if i != float('inf') else i for i in (variation['width'], variation['height']))
+    if variation['crop']:
+        return ImageOps.fit(image, size, method=variation['resample'])
+
+    # Same as Image.thumbnail(), but leaves the image intact for the following variations without copying it
+    x, y = image.size
+    if x > size[0]:
+        x, y = int(size[0]), int(max(float(y) * size[0] / x, 1))
+    if y > size[1]:
+        x, y = int(max(float(x) * size[1] / y, 1)), int(size[1])
+    return image.resize((x, y), variation['resample'])
+
+
+def save_image(storage, file_name, image, file_format):
+    file_buffer = BytesIO()
+    image.save(file_buffer, file_format)
+    if storage.exists(file_name):
+        storage.delete(file_name)
+    storage.save(file_name, ContentFile(file_buffer.getvalue()))
+
+
+def render_photo_variations(file_name, variations, storage):
+    """
+    Fixes the orientation of a stored photo and renders its stdimage variations, decoding the photo only once.
+
+    If the photo doesn't need to be rotated, the original is left as is and JPEG photos are decoded at the smallest
+    scale (down to 1/8) the largest variation allows, so memory use depends on the variations rather than the photo.
+    """
+    with storage.open(file_name) as f:
+        image = Image.open(f)
+        file_format = image.format
+        logger.debug('File format: ' + file_format)
+
+        transpose = orientation_transpose(image)
+        if transpose is not None:
+            # The original has to be rewritten, so it's needed at full size
+            image = image.transpose(transpose)
+        else:
+            sizes = [decoded_size(image.size, variation) for variation in variations.values()]
+            if sizes:
+                image.draft(image.mode, (max(w for w, h in sizes), max(h for w, h in sizes)))
+            image.load()
+
+    if transpose is not None:
+        save_image(storage, file_name, image, file_format)
+
+    for variation in variations.values():
+        variation_name = StdImageFieldFile.get_variation_name(file_name, variation['name'])
+        save_image(storage, variation_name, resize(image, variation), file_format)
@@ -0,0 +1,82 @@
+import json
+import logging
+import traceback
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from backend.models import Job, JOB_PENDING, JOB_RUNNING, JOB_FAILED
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# A running job which didn't finish in this time is assumed to be abandoned by a crashed worker and is run again
+JOB_TIMEOUT = timedelta(minutes=10)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=30 * 2 ** (attempts - 1))
+
+
+def enqueue(task, *args):
+    """
+    Schedules task (dotted path of a function) to be called with args by a worker.
+    The job is part of the current transaction, so it's only picked up once that commits.
+    """
+    return Job.objects.create(task=task, args=json.dumps(args))
+
+
+def claim_job():
+    """
+    Marks the next due job as running and returns it, or returns None if there is nothing to do
+    """
+    while True:
+        now = timezone.now()
+        job = Job.objects.filter(status__in=[JOB_PENDING, JOB_RUNNING], run_after__lte=now).order_by('run_after', 'id').first()
+        if job is None:
+            return None
+
+        # Another worker might be claiming the same job, the attempt counter tells if we got there first
+        claimed = Job.objects.filter(pk=job.pk, attempts=job.attempts).update(
+            status=JOB_RUNNING, attempts=F('attempts') + 1, run_after=now + JOB_TIMEOUT)
+        if claimed:
+            job.status, job.attempts, job.run_after = JOB_RUNNING, job.attempts + 1, now + JOB_TIMEOUT
+            return job
+
+
+def run_job(job):
+    func = import_string(job.task)
+    args = json.loads(job.args)
+    try:
+        func(*args)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts < MAX_ATTEMPTS:
+            logger.warning('Job %s failed, retrying later:\n%s' % (job, error))
+            Job.objects.filter(pk=job.pk).update(
+                status=JOB_PENDING, run_after=timezone.now() + retry_delay(job.attempts), last_error=error)
+        else:
+            logger.error('Job %s failed for the last time:\n%s' % (job, error))
+            Job.objects.filter(pk=job.pk).update(status=JOB_FAILED, last_error=error)
+            on_failure = getattr(func, 'on_failure', None)
+            if on_failure is not None:
+                on_failure(*args)
+        return False
+    else:
+        job.delete()
+        return True
+
+
+def run_pending_jobs():
+    """
+    Runs jobs until there are none due, returns the number of jobs run
+    """
+    count = 0
+    job = claim_job()
+    while job is not None:
+        run_job(job)
+        count += 1
+        job = claim_job()
+    return count
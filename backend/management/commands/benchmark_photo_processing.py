@@ -0,0 +1,109 @@
+import shutil
+import struct
+import tempfile
+import time
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from six import BytesIO
+from stdimage.utils import render_variations
+
+from backend.images import render_photo_variations
+from backend.models import Photo
+
+
+# The processing as it was done before backend.images, kept for comparison
+def legacy_render_variations(file_name, variations, storage):
+    with storage.open(file_name) as f:
+        with Image.open(f) as image:
+            file_format = image.format
+            if file_format == 'JPEG':
+                exif = image._getexif()
+
+                # if image has exif data about orientation, let's rotate it
+                orientation_key = 274  # cf ExifTags
+                if exif and orientation_key in exif:
+                    orientation = exif[orientation_key]
+
+                    rotate_values = {
+                        3: Image.ROTATE_180,
+                        6: Image.ROTATE_270,
+                        8: Image.ROTATE_90
+                    }
+
+                    if orientation in rotate_values:
+                        image = image.transpose(rotate_values[orientation])
+
+                    file_buffer = BytesIO()
+                    image.save(file_buffer, file_format)
+                    f = ContentFile(file_buffer.getvalue())
+                    storage.delete(file_name)
+                    storage.save(file_name, f)
+
+    # render stdimage variations
+    render_variations(file_name, variations, replace=True, storage=storage)
+
+
+class CountingStorage(FileSystemStorage):
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.opens = self.saves = 0
+
+    def _open(self, name, mode='rb'):
+        self.opens += 1
+        return super(CountingStorage, self)._open(name, mode)
+
+    def _save(self, name, content):
+        self.saves += 1
+        return super(CountingStorage, self)._save(name, content)
+
+
+def exif_orientation(orientation):
+    # A minimal big endian TIFF structure with a single Orientation tag
+    return b'Exif\x00\x00MM\x00\x2a' + struct.pack('>IHHHIHHI', 8, 1, 274, 3, 1, orientation, 0, 0)
+
+
+def sample_photo(width, height, orientation):
+    noise = Image.effect_noise((width, height), 64)
+    image = Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    file_buffer = BytesIO()
+    if orientation:
+        image.save(file_buffer, 'JPEG', quality=90, exif=exif_orientation(orientation))
+    else:
+        image.save(file_buffer, 'JPEG', quality=90)
+    return file_buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = 'Compares the time and storage traffic of the current and the legacy photo processing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--width', type=int, default=4000)
+        parser.add_argument('--height', type=int, default=3000)
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        variations = Photo._meta.get_field('photo').variations
+        for orientation in (None, 6):
+            data = sample_photo(options['width'], options['height'], orientation)
+            self.stdout.write('%dx%d JPEG, %d KiB, %s:' % (
+                options['width'], options['height'], len(data) // 1024,
+                'rotated' if orientation else 'not rotated'))
+
+            for name, func in (('legacy', legacy_render_variations), ('current', render_photo_variations)):
+                location = tempfile.mkdtemp()
+                try:
+                    storage = CountingStorage(location=location)
+                    elapsed = 0
+                    for run in range(options['runs']):
+                        file_name = storage.save('photo%d.jpg' % run, ContentFile(data))
+                        start = time.time()
+                        func(file_name, variations, storage)
+                        elapsed += time.time() - start
+                    self.stdout.write('  %-8s %7.1f ms/photo, %.1f opens/photo, %.1f writes/photo' % (
+                        name, elapsed * 1000 / options['runs'],
+                        float(storage.opens) / options['runs'], float(storage.saves) / options['runs']))
+                finally:
+                    shutil.rmtree(location)
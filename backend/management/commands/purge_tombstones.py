@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from backend.sync import purge_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Deletes the records of deleted objects which are too old for the delta sync'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Deleted %d tombstone(s)' % purge_tombstones())
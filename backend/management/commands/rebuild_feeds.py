@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.feed import rebuild_feeds
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the feeds of all users from the tags they follow'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_feeds()
+        self.stdout.write('Rebuilt the feeds of %d user(s)' % count)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from backend.clusters import rebuild_clusters
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the map clusters of all places from scratch'
+
+    def handle(self, *args, **options):
+        cells = rebuild_clusters()
+        self.stdout.write('Built %d cluster cell(s)' % cells)
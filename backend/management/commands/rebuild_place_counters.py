@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Sum, When
+from django.utils import timezone
+
+from backend.models import Place
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized visit and rating counters of all places from the Visit table'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            places = Place.objects.annotate(
+                real_visit_count=Count('visits'),
+                real_rating_count=Count(Case(When(visits__rating__gt=0, then=1), output_field=IntegerField())),
+                real_rating_sum=Sum('visits__rating'),
+            ).values_list('pk', 'visit_count', 'rating_count', 'rating_sum',
+                          'real_visit_count', 'real_rating_count', 'real_rating_sum')
+
+            fixed = 0
+            for pk, visit_count, rating_count, rating_sum, real_visit_count, real_rating_count, real_rating_sum in places.iterator():
+                real_rating_sum = real_rating_sum or 0
+                if (visit_count, rating_count, rating_sum) == (real_visit_count, real_rating_count, real_rating_sum):
+                    continue
+                # The counters are serialized, so the place has to look changed
+                Place.objects.filter(pk=pk).update(visit_count=real_visit_count, rating_count=real_rating_count,
+                                                   rating_sum=real_rating_sum, date_modified=timezone.now())
+                fixed += 1
+
+        self.stdout.write('Fixed counters of %d place(s)' % fixed)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Recreates the full-text index of places used by the search'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_search_index()
+        self.stdout.write('Indexed %d place(s)' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.tags import rebuild_tag_tree
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the paths and place counts of all tags from scratch'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_tag_tree()
+        self.stdout.write('Rebuilt %d tag(s)' % count)
@@ -0,0 +1,21 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from backend.db.routers import beat
+
+
+class Command(BaseCommand):
+    help = ('Writes a heartbeat on the primary database every REPLICA_HEARTBEAT_INTERVAL seconds, which tells how far '
+            'behind the replicas are. REPLICA_SELECTION = \'least-lag\' needs it running.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Write a single heartbeat and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            beat()
+            if options['once']:
+                break
+            time.sleep(settings.REPLICA_HEARTBEAT_INTERVAL)
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from backend.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs background jobs (e.g. rendering uploaded photos) as they are queued'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once there are no more jobs due')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait before checking for new jobs')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_jobs()
+            if count:
+                self.stdout.write('Ran %d job(s)' % count)
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
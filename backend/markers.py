@@ -0,0 +1,101 @@
+import struct
+
+from django.db.models import FloatField, Func
+from django.utils.encoding import force_bytes
+
+# Decimal places of the coordinates, about 10 cm
+COORD_PRECISION = 6
+
+# Binary layout, all little endian: magic, count, then the columns one after another
+BINARY_MAGIC = b'WMK1'
+
+
+class PointX(Func):
+    function = 'ST_X'
+
+    def __init__(self, expression, **extra):
+        super(PointX, self).__init__(expression, output_field=FloatField(), **extra)
+
+
+class PointY(Func):
+    function = 'ST_Y'
+
+    def __init__(self, expression, **extra):
+        super(PointY, self).__init__(expression, output_field=FloatField(), **extra)
+
+
+def marker_columns(queryset, top_tag=False):
+    """
+    Reads the markers of the places in the queryset into {'id': [...], 'name': [...], 'lat': [...], 'lng': [...]},
+    straight from the columns, without creating any model instances.
+
+    With top_tag, 'tag' holds the name of the most used tag of each place, or None.
+    """
+    queryset = queryset.prefetch_related(None).annotate(marker_lat=PointY('coords'), marker_lng=PointX('coords'))
+    names = ['id', 'name', 'marker_lat', 'marker_lng']
+    if top_tag:
+        # One row for each tag of a place, next to each other
+        queryset = queryset.order_by('id')
+        names += ['tags__name', 'tags__place_count']
+    else:
+        queryset = queryset.order_by()
+
+    columns = {'id': [], 'name': [], 'lat': [], 'lng': []}
+    if top_tag:
+        columns['tag'] = []
+    last_id = best_count = None
+    for row in queryset.values_list(*names).iterator():
+        if top_tag and row[0] == last_id:
+            if row[5] > best_count:
+                columns['tag'][-1], best_count = row[4], row[5]
+            continue
+
+        columns['id'].append(row[0])
+        columns['name'].append(row[1])
+        columns['lat'].append(round(row[2], COORD_PRECISION))
+        columns['lng'].append(round(row[3], COORD_PRECISION))
+        if top_tag:
+            columns['tag'].append(row[4])
+            last_id, best_count = row[0], row[5]
+    return columns
+
+
+def markers_geojson(columns):
+    """
+    Turns marker columns into a GeoJSON FeatureCollection of points
+    """
+    if 'tag' in columns:
+        properties = [{'name': name, 'tag': tag} for name, tag in zip(columns['name'], columns['tag'])]
+    else:
+        properties = [{'name': name} for name in columns['name']]
+    features = [{
+        'type': 'Feature',
+        'id': pk,
+        'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+        'properties': props,
+    } for pk, lat, lng, props in zip(columns['id'], columns['lat'], columns['lng'], properties)]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def pack_strings(strings):
+    data = [force_bytes(s) if s is not None else b'' for s in strings]
+    return struct.pack('<%dH' % len(data), *[len(s) for s in data]) + b''.join(data)
+
+
+def markers_binary(columns):
+    """
+    Packs marker columns into BINARY_MAGIC, the uint32 count, the int32 ids, the float32 latitudes and longitudes,
+    then the names, and the tags if present, as uint16 UTF-8 lengths followed by the UTF-8 strings. Missing tags
+    are empty.
+    """
+    count = len(columns['id'])
+    parts = [
+        struct.pack('<4sI', BINARY_MAGIC, count),
+        struct.pack('<%di' % count, *columns['id']),
+        struct.pack('<%df' % count, *columns['lat']),
+        struct.pack('<%df' % count, *columns['lng']),
+        pack_strings(columns['name']),
+    ]
+    if 'tag' in columns:
+        parts.append(pack_strings(columns['tag']))
+    return b''.join(parts)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Count, IntegerField, Sum, When
+
+
+def fill_place_counters(apps, schema_editor):
+    Place = apps.get_model('backend', 'Place')
+    places = Place.objects.annotate(
+        real_visit_count=Count('visits'),
+        real_rating_count=Count(Case(When(visits__rating__gt=0, then=1), output_field=IntegerField())),
+        real_rating_sum=Sum('visits__rating'),
+    ).values_list('pk', 'real_visit_count', 'real_rating_count', 'real_rating_sum')
+    for pk, visit_count, rating_count, rating_sum in places:
+        Place.objects.filter(pk=pk).update(visit_count=visit_count, rating_count=rating_count, rating_sum=rating_sum or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0011_userprofile_saved_places'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='rating_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_sum',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='visit_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_place_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:08
+from __future__ import unicode_literals
+
+import math
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# A copy of backend.clusters as of this migration, so later changes there don't change what it does
+MAX_CLUSTER_ZOOM = 16
+CELLS_PER_TILE = 4
+MAX_LAT = 85.0511287798
+
+
+def cell_for(lat, lng, zoom):
+    n = CELLS_PER_TILE << zoom
+    lat_rad = math.radians(max(min(lat, MAX_LAT), -MAX_LAT))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def build_cells(places):
+    cells = {}
+    for pk, lat, lng in places:
+        for zoom in range(MAX_CLUSTER_ZOOM + 1):
+            key = (zoom,) + cell_for(lat, lng, zoom)
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [1, lat, lng, pk]
+            else:
+                cell[0] += 1
+                cell[1] += lat
+                cell[2] += lng
+    return cells
+
+
+def fill_place_clusters(apps, schema_editor):
+    Place = apps.get_model('backend', 'Place')
+    PlaceCluster = apps.get_model('backend', 'PlaceCluster')
+    cells = build_cells((pk, coords.y, coords.x) for pk, coords in Place.objects.values_list('pk', 'coords'))
+    PlaceCluster.objects.bulk_create([
+        PlaceCluster(zoom=zoom, x=x, y=y, count=count, lat_sum=lat_sum, lng_sum=lng_sum, place_id=place_id)
+        for (zoom, x, y), (count, lat_sum, lng_sum, place_id) in cells.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0012_place_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaceCluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('lat_sum', models.FloatField(default=0)),
+                ('lng_sum', models.FloatField(default=0)),
+                ('place', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='backend.Place')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='placecluster',
+            unique_together=set([('zoom', 'x', 'y')]),
+        ),
+        migrations.RunPython(fill_place_clusters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:10
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0013_placecluster'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='place',
+            index_together=set([('date_modified', 'id')]),
+        ),
+    ]
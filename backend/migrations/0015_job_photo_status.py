@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0014_place_pagination_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=200)),
+                ('args', models.TextField(default=b'[]')),
+                ('status', models.CharField(choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'failed', b'Failed')], default=b'pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        # Photos uploaded so far had their variations rendered right away
+        migrations.AddField(
+            model_name='photo',
+            name='status',
+            field=models.CharField(choices=[(b'pending', b'Pending'), (b'ready', b'Ready'), (b'failed', b'Failed')], default=b'ready', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='photo',
+            name='status',
+            field=models.CharField(choices=[(b'pending', b'Pending'), (b'ready', b'Ready'), (b'failed', b'Failed')], default=b'pending', max_length=10),
+        ),
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('status', 'run_after')]),
+        ),
+    ]
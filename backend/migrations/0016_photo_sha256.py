@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:15
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def file_sha256(f):
+    sha256 = hashlib.sha256()
+    for chunk in f.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_existing_photos(apps, schema_editor):
+    Photo = apps.get_model('backend', 'Photo')
+    seen = set()
+    for photo in Photo.objects.order_by('pk'):
+        try:
+            photo.photo.open('rb')
+            sha256 = file_sha256(photo.photo)
+            photo.photo.close()
+        except (IOError, OSError):
+            continue  # missing file
+        # Keep the first of any duplicates which are already there
+        if (photo.place_id, sha256) in seen:
+            continue
+        seen.add((photo.place_id, sha256))
+        Photo.objects.filter(pk=photo.pk).update(sha256=sha256)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0015_job_photo_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='sha256',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(hash_existing_photos, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='photo',
+            unique_together=set([('place', 'sha256')]),
+        ),
+    ]
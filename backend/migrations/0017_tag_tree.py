@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:19
+from __future__ import unicode_literals
+
+from collections import defaultdict, Counter
+
+from django.db import migrations, models
+
+
+def fill_tag_tree(apps, schema_editor):
+    # A copy of backend.tags.rebuild_tag_tree as of this migration, so later changes there don't change what it does
+    Tag = apps.get_model('backend', 'Tag')
+    PlaceTag = apps.get_model('backend', 'Place').tags.through
+
+    children = defaultdict(list)
+    for tag_id, parent_id in Tag.objects.values_list('pk', 'parent_id'):
+        children[parent_id].append(tag_id)
+
+    paths = {}
+    stack = [(tag_id, '/') for tag_id in children[None]]
+    while stack:
+        tag_id, parent_path = stack.pop()
+        paths[tag_id] = '%s%d/' % (parent_path, tag_id)
+        stack.extend((child_id, paths[tag_id]) for child_id in children[tag_id])
+
+    place_counts = Counter()
+    subtree_places = defaultdict(set)
+    for place_id, tag_id in PlaceTag.objects.values_list('place_id', 'tag_id'):
+        place_counts[tag_id] += 1
+        for ancestor_id in [int(i) for i in paths.get(tag_id, '').split('/') if i]:
+            subtree_places[ancestor_id].add(place_id)
+
+    for tag_id, path in paths.items():
+        Tag.objects.filter(pk=tag_id).update(
+            path=path, place_count=place_counts[tag_id], subtree_place_count=len(subtree_places[tag_id]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0016_photo_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='path',
+            field=models.CharField(db_index=True, default=b'', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='place_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='subtree_place_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_tag_tree, migrations.RunPython.noop),
+    ]
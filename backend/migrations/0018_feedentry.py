@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:41
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+# A copy of backend.feed.place_score as of this migration, so later changes there don't change what it does
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+PRIOR_RATING = 2.0
+PRIOR_COUNT = 3
+DAYS_PER_STAR = 7.0
+
+
+def place_score(date_created, rating_sum, rating_count):
+    days = (date_created - EPOCH).total_seconds() / 86400
+    rating = (rating_sum + PRIOR_RATING * PRIOR_COUNT) / (rating_count + PRIOR_COUNT)
+    return days + DAYS_PER_STAR * rating
+
+
+def fill_feeds(apps, schema_editor):
+    UserProfile = apps.get_model('backend', 'UserProfile')
+    Place = apps.get_model('backend', 'Place')
+    FeedEntry = apps.get_model('backend', 'FeedEntry')
+
+    scores = {}
+    for place_id, date_created, rating_sum, rating_count in Place.objects.values_list('pk', 'date_created', 'rating_sum', 'rating_count'):
+        scores[place_id] = place_score(date_created, rating_sum, rating_count)
+
+    for profile in UserProfile.objects.all():
+        place_ids = set()
+        for path in profile.followed_tags.values_list('path', flat=True):
+            # The tag and its descendants, see backend.tags.subtree_filter
+            subtree = Place.tags.through.objects.filter(tag__path__gte=path, tag__path__lt=path[:-1] + '0')
+            place_ids.update(subtree.values_list('place_id', flat=True))
+        FeedEntry.objects.bulk_create([
+            FeedEntry(user_id=profile.user_id, place_id=place_id, score=scores[place_id]) for place_id in place_ids
+        ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('backend', '0017_tag_tree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='backend.Place')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='feedentry',
+            unique_together=set([('user', 'place')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='feedentry',
+            index_together=set([('user', 'score', 'id')]),
+        ),
+        migrations.RunPython(fill_feeds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# The index of backend.search.SQLiteSearchBackend as of this migration, so later changes there don't change what it
+# does
+TABLE = 'backend_place_fts'
+
+
+def create_search_index(apps, schema_editor):
+    Place = apps.get_model('backend', 'Place')
+    places = Place.objects.using(schema_editor.connection.alias).values_list('pk', 'name', 'description')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s' % TABLE)
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(name, description, "
+                       "tokenize='unicode61 remove_diacritics 1')" % TABLE)
+        cursor.executemany('INSERT INTO %s (rowid, name, description) VALUES (%%s, %%s, %%s)' % TABLE, list(places))
+
+
+def drop_search_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s' % TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0018_feedentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
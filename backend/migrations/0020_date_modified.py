@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 10:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0019_place_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -1,17 +1,15 @@
-import logging
+import hashlib
 import os
-import time
 
 import stdimage
-from PIL import Image
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models as gis_models
-from django.core.files.base import ContentFile
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import F
 from django.db.models.signals import post_save
+from django.utils import timezone
 from django.utils.encoding import force_bytes
-from six import BytesIO
-from stdimage.utils import render_variations
 
 
 class UserProfile(models.Model):
@@ -19,6 +17,8 @@ class UserProfile(models.Model):
     first_login = models.BooleanField(default=True)
     followed_tags = models.ManyToManyField('Tag', blank=True, related_name='followers')
     saved_places = models.ManyToManyField('Place', blank=True, related_name='saved_by')
+    # Also bumped when the user or the relations change, see backend.conditional
+    date_modified = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return force_bytes("%s's profile" % self.user)
@@ -35,9 +35,21 @@ class Tag(models.Model):
     name = models.CharField(max_length=50, unique=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, blank=True, null=True, related_name='children')
 
+    # Maintained by backend.tags: ids of the ancestors and the tag itself, e.g. '/1/5/12/', and the number
+    # of places with the tag and with the tag or any of its descendants
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
+    place_count = models.IntegerField(default=0, editable=False)
+    subtree_place_count = models.IntegerField(default=0, editable=False)
+    # Also bumped by the updates of the counts and the parent's name, see backend.conditional
+    date_modified = models.DateTimeField(auto_now=True, db_index=True)
+
     def __str__(self):
         return force_bytes('#'+self.name)
 
+    def clean(self):
+        if self.pk is not None and self.parent is not None and ('/%d/' % self.pk) in self.parent.path:
+            raise ValidationError({'parent': 'A tag cannot be its own ancestor.'})
+
 
 class Place(models.Model):
     name = models.CharField(max_length=300)
@@ -45,55 +57,98 @@ class Place(models.Model):
     tags = models.ManyToManyField(Tag)
     author = models.ForeignKey('auth.User', on_delete=models.SET_NULL, null=True, related_name='added_places')
     date_created = models.DateTimeField(auto_now_add=True)
+    # Also bumped when the counters, photos or tags change, see backend.conditional
     date_modified = models.DateTimeField(auto_now=True)
     coords = gis_models.PointField()
 
+    # Denormalized from Visit, see counter_updates() and the rebuild_place_counters command
+    rating_sum = models.IntegerField(default=0, editable=False)
+    rating_count = models.IntegerField(default=0, editable=False)
+    visit_count = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        # For the delta sync and the validators of the responses
+        index_together = ['date_modified', 'id']
+
     def __str__(self):
         return force_bytes(self.name + ' @ ' + str(self.coords.x) + ';' + str(self.coords.y))
 
+    @property
+    def rating_avg(self):
+        if not self.rating_count:
+            return None
+        return float(self.rating_sum) / self.rating_count
+
+    @staticmethod
+    def counter_updates(old_rating, new_rating):
+        """
+        Returns update() arguments that replace a visit rated old_rating with one rated new_rating in the counters,
+        bumping date_modified. None stands for no visit at all, 0 for a visit without a rating.
+        """
+        return {
+            'date_modified': timezone.now(),
+            'visit_count': F('visit_count') + int(new_rating is not None) - int(old_rating is not None),
+            'rating_count': F('rating_count') + int(bool(new_rating)) - int(bool(old_rating)),
+            'rating_sum': F('rating_sum') + (new_rating or 0) - (old_rating or 0),
+        }
+
+
+class PlaceCluster(models.Model):
+    """
+    Places aggregated into a cell of the map grid at a given zoom level, maintained by backend.clusters
+    """
+    zoom = models.PositiveSmallIntegerField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    count = models.IntegerField(default=0)
+    lat_sum = models.FloatField(default=0)
+    lng_sum = models.FloatField(default=0)
+    place = models.ForeignKey(Place, on_delete=models.SET_NULL, null=True, related_name='+')
 
-def photo_path(instance, filename):
-    return 'photos/{0}/{1}{2}'.format(instance.place.id, int(round(time.time() * 1000)), os.path.splitext(filename)[1])
+    class Meta:
+        unique_together = ['zoom', 'x', 'y']
 
+    def __str__(self):
+        return force_bytes('%d places in cell %d/%d/%d' % (self.count, self.zoom, self.x, self.y))
 
-# see https://github.com/codingjoe/django-stdimage/issues/66#issuecomment-180309788
-def photo_render_variations(file_name, variations, storage):
-    with storage.open(file_name) as f:
-        with Image.open(f) as image:
-            file_format = image.format
-            logging.info('File format: ' + file_format)
-            if file_format == 'JPEG':
-                exif = image._getexif()
 
-                # if image has exif data about orientation, let's rotate it
-                orientation_key = 274  # cf ExifTags
-                if exif and orientation_key in exif:
-                    orientation = exif[orientation_key]
+def file_sha256(f):
+    sha256 = hashlib.sha256()
+    for chunk in f.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
 
-                    rotate_values = {
-                        3: Image.ROTATE_180,
-                        6: Image.ROTATE_270,
-                        8: Image.ROTATE_90
-                    }
 
-                    if orientation in rotate_values:
-                        image = image.transpose(rotate_values[orientation])
+def photo_path(instance, filename):
+    # Uploads through the API are hashed by HashingFileUploadParser already
+    if not instance.sha256:
+        instance.sha256 = file_sha256(instance.photo)
+    return 'photos/{0}/{1}/{2}{3}'.format(instance.sha256[0:2], instance.sha256[2:4], instance.sha256, os.path.splitext(filename)[1].lower())
 
-                    file_buffer = BytesIO()
-                    image.save(file_buffer, file_format)
-                    f = ContentFile(file_buffer.getvalue())
-                    storage.delete(file_name)
-                    storage.save(file_name, f)
 
-    # render stdimage variations
-    render_variations(file_name, variations, replace=True, storage=storage)
+PHOTO_PENDING = 'pending'
+PHOTO_READY = 'ready'
+PHOTO_FAILED = 'failed'
 
-    return False  # prevent default rendering
+PHOTO_STATUSES = (
+    (PHOTO_PENDING, 'Pending'),
+    (PHOTO_READY, 'Ready'),
+    (PHOTO_FAILED, 'Failed'),
+)
 
 
 class Photo(models.Model):
-    photo = stdimage.StdImageField(upload_to=photo_path, render_variations=photo_render_variations, variations={'resized': {'width': 2048, 'height': 2048}})
+    # Variations are rendered in the background by backend.tasks.render_photo
+    photo = stdimage.StdImageField(upload_to=photo_path, render_variations=False, variations={'resized': {'width': 2048, 'height': 2048}})
     place = models.ForeignKey(Place, on_delete=models.CASCADE, related_name='photos')
+    status = models.CharField(max_length=10, choices=PHOTO_STATUSES, default=PHOTO_PENDING)
+    # Of the file as uploaded, used to recognize the same photo uploaded again
+    sha256 = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    # Also bumped when the status changes, see backend.tasks
+    date_modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        unique_together = ['place', 'sha256']
 
     def __str__(self):
         return force_bytes('Photo for ' + str(self.place))
@@ -113,9 +168,83 @@ class Visit(models.Model):
     visitor = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='visited_places')
     date_visited = models.DateTimeField(auto_now_add=True)
     rating = models.IntegerField(default=0, blank=True, choices=RATINGS)
+    date_modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ['place', 'visitor']
+        # For the delta sync
+        index_together = ['visitor', 'date_modified']
 
     def __str__(self):
         return force_bytes(str(self.visitor) + '\'s visit to ' + str(self.place) + ' at ' + str(self.date_visited))
+
+
+class FeedEntry(models.Model):
+    """
+    A place in the feed of a user, because it has one of the followed tags. Maintained by backend.feed
+    """
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='feed_entries')
+    place = models.ForeignKey(Place, on_delete=models.CASCADE, related_name='feed_entries')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ['user', 'place']
+        index_together = ['user', 'score', 'id']
+
+    def __str__(self):
+        return force_bytes(str(self.place) + ' in the feed of ' + str(self.user))
+
+
+class Tombstone(models.Model):
+    """
+    A deleted object, reported by the delta sync until it's older than SYNC_TOMBSTONE_DAYS, see backend.sync
+    """
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    # Only reported to this user, e.g. for visits
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE, null=True, related_name='+')
+    date_deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return force_bytes('Deleted %s %d' % (self.model, self.object_id))
+
+
+class ReplicationHeartbeat(models.Model):
+    """
+    The time of the last heartbeat, written on the primary by the replication_heartbeat command. Its copy on a replica
+    tells how far behind the replica is, see backend.db.routers.LagMonitor
+    """
+    date = models.DateTimeField()
+
+    def __str__(self):
+        return force_bytes('Heartbeat at %s' % self.date)
+
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_FAILED = 'failed'
+
+JOB_STATUSES = (
+    (JOB_PENDING, 'Pending'),
+    (JOB_RUNNING, 'Running'),
+    (JOB_FAILED, 'Failed'),
+)
+
+
+class Job(models.Model):
+    """
+    A background task waiting to be run by the run_jobs command, see backend.jobs
+    """
+    task = models.CharField(max_length=200)
+    args = models.TextField(default='[]')
+    status = models.CharField(max_length=10, choices=JOB_STATUSES, default=JOB_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = ['status', 'run_after']
+
+    def __str__(self):
+        return force_bytes('%s%s (%s)' % (self.task, self.args, self.status))
@@ -0,0 +1,276 @@
+import errno
+import glob
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.encoding import force_bytes
+from rest_framework.renderers import JSONRenderer
+from rest_framework.reverse import reverse
+
+from backend.models import Photo, PHOTO_READY
+from backend.photo_cache import get_variant
+from backend.serializers import PlaceSerializer
+
+# Places serialized at a time, which bounds the memory used by a pack of any size
+PLACES_PER_BATCH = 200
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipStream(object):
+    """
+    Writes a zip archive as a sequence of chunks, without seeking back, so it can be streamed as it's made.
+    The sizes and checksums follow the data of each file in data descriptors. No ZIP64, so archives are limited
+    to 4 GB.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.offset = 0
+        self.date_time = self.dos_date_time(time.localtime())
+
+    @staticmethod
+    def dos_date_time(t):
+        return ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+                t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def add_file(self, name, chunks, compress=False):
+        """
+        Yields the chunks of the archive holding a file with the content of the chunks of bytes
+        """
+        name = force_bytes(name)
+        method = 8 if compress else 0
+        # Bit 3: sizes and checksum in the data descriptor, bit 11: UTF-8 names
+        flags = 0x08 | 0x800
+        date, time_ = self.date_time
+        header_offset = self.offset
+        yield self._emit(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, time_, date, 0, 0, 0,
+                                     len(name), 0) + name)
+
+        crc, size, compressed_size = 0, 0, 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if compress else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compressed_size += len(chunk)
+                yield self._emit(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield self._emit(chunk)
+
+        crc &= 0xffffffff
+        if max(size, compressed_size, self.offset) > 0xffffffff:
+            raise ValueError('The archive is too large.')
+        yield self._emit(struct.pack('<IIII', 0x08074b50, crc, compressed_size, size))
+        self.entries.append((name, flags, method, crc, compressed_size, size, header_offset))
+
+    def close(self):
+        """
+        Yields the central directory, which ends the archive
+        """
+        date, time_ = self.date_time
+        directory_offset = self.offset
+        for name, flags, method, crc, compressed_size, size, header_offset in self.entries:
+            yield self._emit(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, method, time_, date, crc,
+                                         compressed_size, size, len(name), 0, 0, 0, 0, 0, header_offset) + name)
+        yield self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                     self.offset - directory_offset, directory_offset, 0))
+
+
+def pack_region(request, bbox, tags, words, size, image_type):
+    """
+    Identifies what a pack holds: the host its urls point to, the filters choosing the places, normalized so that
+    equivalent requests share their pack, and the photo variants. Nothing else the client sends makes a difference.
+    """
+    region = {
+        'in_bbox': bbox,
+        'tag': sorted(set(tags)),
+        'q': sorted(set(word.lower() for word in words)),
+        'size': size,
+        'type': image_type,
+    }
+    return request.build_absolute_uri('/') + '?' + json.dumps(region, sort_keys=True)
+
+
+def pack_version(places):
+    """
+    Changes whenever any place in the pack or anything shown with it does, like ConditionalGetMixin's validators
+    """
+    stats = places.order_by().aggregate(last_modified=Max('date_modified'), count=Count('pk'))
+    last_modified = stats['last_modified'].isoformat() if stats['last_modified'] else ''
+    return '%s:%d' % (last_modified, stats['count'])
+
+
+def pack_path(region, version):
+    """
+    Returns the path of a cached pack of a region ('' for all the packs of the region) for the given version
+    """
+    region_hash = hashlib.md5(force_bytes(region)).hexdigest()
+    version_hash = hashlib.md5(force_bytes(version)).hexdigest()[:12] if version else ''
+    return os.path.join(settings.OFFLINE_PACK_ROOT, '%s-%s' % (region_hash, version_hash))
+
+
+def place_batches(places):
+    batch = []
+    for place in places.iterator():
+        batch.append(place)
+        if len(batch) == PLACES_PER_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def places_json(request, places):
+    """
+    Yields the JSON list of the places serialized like in the API, a batch at a time
+    """
+    renderer = JSONRenderer()
+    yield b'['
+    first = True
+    for batch in place_batches(places):
+        serializer = PlaceSerializer(batch, many=True, context={'request': request, 'all_fields': True})
+        # Packs are shared by everyone, so they can't have the visits of the user
+        serializer.child._readable_fields = [
+            field for field in serializer.child._readable_fields if field.field_name != 'visit']
+        data = renderer.render(serializer.data)
+        # Without the brackets of the list
+        yield (b'' if first else b',') + data[1:-1]
+        first = False
+    yield b']'
+
+
+def file_chunks(f):
+    with f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def photo_name(photo_id, image_type):
+    return 'photos/%d.%s' % (photo_id, image_type)
+
+
+def photos_json(request, photos, image_type):
+    """
+    Yields the JSON list of {url, place, file} of the photos, one at a time
+    """
+    yield b'['
+    for i, (pk, place_id) in enumerate(photos.values_list('pk', 'place_id').iterator()):
+        yield (b',' if i else b'') + force_bytes(json.dumps({
+            'url': reverse('photo-detail', kwargs={'pk': pk}, request=request),
+            'place': reverse('place-detail', kwargs={'pk': place_id}, request=request),
+            'file': photo_name(pk, image_type),
+        }))
+    yield b']'
+
+
+def pack_chunks(request, places, size, image_type):
+    """
+    Yields the chunks of a zip with places.json, photos.json describing the photos and the photos themselves,
+    downsized to the given size from PHOTO_SIZES
+    """
+    archive = ZipStream()
+    for chunk in archive.add_file('places.json', places_json(request, places), compress=True):
+        yield chunk
+
+    photos = Photo.objects.filter(place__in=places.order_by().values('pk'), status=PHOTO_READY).order_by('pk')
+    for chunk in archive.add_file('photos.json', photos_json(request, photos, image_type), compress=True):
+        yield chunk
+    for photo in photos.iterator():
+        variant = get_variant(photo, size, image_type)
+        for chunk in archive.add_file(photo_name(photo.pk, image_type), file_chunks(variant)):
+            yield chunk
+
+    for chunk in archive.close():
+        yield chunk
+
+
+def cached_pack(region, version):
+    """
+    Returns the cached pack as an open file, or None
+    """
+    path = pack_path(region, version) + '.zip'
+    try:
+        pack = open(path, 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    # The modification time is what the eviction uses to find the least recently used packs
+    os.utime(path, None)
+    return pack
+
+
+def evict_packs(kept_path):
+    """
+    Removes the least recently used packs (except the one just made) while the packs take more than
+    OFFLINE_PACK_MAX_SIZE. There are few of them, so the directory is simply scanned every time.
+    """
+    packs = []
+    for path in glob.glob(os.path.join(settings.OFFLINE_PACK_ROOT, '*.zip')):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed in the meantime
+        packs.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in packs)
+    for _, size, path in sorted(packs):
+        if total_size <= settings.OFFLINE_PACK_MAX_SIZE:
+            break
+        if path == kept_path:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+
+
+def caching_pack_chunks(chunks, region, version):
+    """
+    Passes the chunks on while writing them to the cache. The pack is only cached once it's complete,
+    replacing the older versions of the region, and evicting other packs when the cache is full.
+    """
+    try:
+        os.makedirs(settings.OFFLINE_PACK_ROOT)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    path = pack_path(region, version) + '.zip'
+    fd, temp_path = tempfile.mkstemp(dir=settings.OFFLINE_PACK_ROOT, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+                yield chunk
+        for old_path in glob.glob(pack_path(region, '') + '*.zip'):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+        os.rename(temp_path, path)
+        evict_packs(path)
+    finally:
+        # Also when the client went away in the middle
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
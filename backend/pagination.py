@@ -0,0 +1,138 @@
+import json
+import numbers
+from functools import reduce
+from operator import and_, or_
+
+from django.contrib.gis.measure import Distance
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination over a unique ordering, e.g. ('-score', '-id'). The fields shouldn't change while clients
+    page through the results, or they would see some objects twice and miss others.
+
+    CursorPagination only filters on the first ordering field and skips over ties with an OFFSET. Here the cursor holds
+    the values of all the ordering fields instead, so every page is a single range scan no matter how deep it is.
+    """
+
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = ('id',)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            reverse, position = False, None
+        else:
+            reverse, position = self.cursor.reverse, self.decode_position(self.cursor.position)
+
+        if reverse:
+            queryset = queryset.order_by(*[self.reverse_field(field) for field in self.ordering])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if position is not None:
+            try:
+                queryset = queryset.filter(self.position_filter(position, reverse))
+            except (ValueError, TypeError, ValidationError):
+                # Values of the wrong type for their fields, from a tampered cursor
+                raise NotFound(self.invalid_cursor_message)
+
+        # Fetch an extra item to find out if there's another page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.encode_position(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.encode_position(self.page[0])))
+
+    @staticmethod
+    def reverse_field(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    def position_filter(self, position, reverse):
+        """
+        Matches the rows following the position in the (possibly reversed) ordering, i.e. for ('a', 'b'):
+        a > position[0] OR (a = position[0] AND b > position[1])
+        """
+        if len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        conditions = []
+        for i, field in enumerate(self.ordering):
+            descending = field.startswith('-') != reverse
+            lookup = field.lstrip('-') + ('__lt' if descending else '__gt')
+            equal = [Q(**{previous.lstrip('-'): value}) for previous, value in zip(self.ordering[:i], position)]
+            conditions.append(reduce(and_, equal + [Q(**{lookup: position[i]})]))
+        return reduce(or_, conditions)
+
+    def encode_position(self, instance):
+        position = []
+        for field in self.ordering:
+            value = getattr(instance, field.lstrip('-'))
+            if isinstance(value, Distance):
+                value = value.m
+            elif not isinstance(value, numbers.Number):
+                value = u'%s' % value
+            position.append(value)
+        return json.dumps(position)
+
+    def decode_position(self, position):
+        if position is None:
+            return None
+        try:
+            position = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+
+class PlacePagination(KeysetPagination):
+    # Newest first. Ids never change, unlike date_modified, so places don't move between pages.
+    ordering = ('-id',)
+
+
+class TagPagination(KeysetPagination):
+    ordering = ('name',)
+
+
+class FeedPagination(KeysetPagination):
+    ordering = ('-score', '-id')
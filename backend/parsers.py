@@ -0,0 +1,34 @@
+import hashlib
+
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework.parsers import FileUploadParser
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Computes the SHA-256 of an uploaded file while it is received, passing the data on to the following handlers
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class HashingFileUploadParser(FileUploadParser):
+    """
+    FileUploadParser which also sets the sha256 attribute of the uploaded file to its hex digest
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        hashing_handler = HashingUploadHandler()
+        parser_context['request'].upload_handlers.insert(0, hashing_handler)
+        data_and_files = super(HashingFileUploadParser, self).parse(stream, media_type, parser_context)
+        data_and_files.files['file'].sha256 = hashing_handler.sha256.hexdigest()
+        return data_and_files
@@ -0,0 +1,137 @@
+import errno
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+from django.conf import settings
+from django.db.models.signals import post_delete
+
+from backend.images import decoded_size, resize
+from backend.models import Photo
+
+# Sizes of the photo variants rendered on demand, the photos are fit inside a box of this size
+PHOTO_SIZES = OrderedDict([
+    ('thumb', 200),
+    ('medium', 800),
+    ('large', 2048),
+])
+
+PHOTO_TYPES = OrderedDict([
+    ('jpeg', ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True})),
+    ('webp', ('WEBP', 'image/webp', {'quality': 80})),
+])
+
+_lock = threading.Lock()
+_cache_size = None  # estimated size of the cache in bytes, None until the cache directory is scanned
+
+
+def variant_path(photo_id, size, image_type):
+    return os.path.join(settings.PHOTO_CACHE_ROOT, str(photo_id), '%s.%s' % (size, image_type))
+
+
+def get_variant(photo, size, image_type):
+    """
+    Returns an open file with a cached variant of a photo, rendering it first if needed
+    """
+    path = variant_path(photo.pk, size, image_type)
+    try:
+        variant = open(path, 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        # The modification time is what the eviction uses to find the least recently used variants
+        os.utime(path, None)
+        return variant
+
+    render_variant(photo, size, image_type, path)
+    return open(path, 'rb')
+
+
+def render_variant(photo, size, image_type, path):
+    file_format, _, save_options = PHOTO_TYPES[image_type]
+    variation = {'width': PHOTO_SIZES[size], 'height': PHOTO_SIZES[size], 'crop': False, 'resample': Image.ANTIALIAS}
+
+    # The 2048px resized variation is much cheaper to decode than the original
+    with photo.photo.storage.open(photo.photo.resized.name) as f:
+        image = Image.open(f)
+        image.draft('RGB', decoded_size(image.size, variation))
+        image = resize(image.convert('RGB'), variation)
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Rendered to a temporary file first, so that concurrent requests never see a partially written one
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            image.save(temp_file, file_format, **save_options)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    added_to_cache(path)
+
+
+def scan_cache():
+    """
+    Returns the (modification time, size, path) of all cached variants
+    """
+    files = []
+    for directory, _, names in os.walk(settings.PHOTO_CACHE_ROOT):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed in the meantime
+            files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+
+def added_to_cache(added_path):
+    """
+    Evicts the least recently used variants (except the one just added) once the cache grows
+    over PHOTO_CACHE_MAX_SIZE.
+
+    Other processes write to the cache too, so the size is only an estimate which is corrected by rescanning
+    the cache whenever it looks like it's full.
+    """
+    global _cache_size
+    with _lock:
+        if _cache_size is not None:
+            _cache_size += os.path.getsize(added_path)
+            if _cache_size <= settings.PHOTO_CACHE_MAX_SIZE:
+                return
+
+        files = scan_cache()
+        _cache_size = sum(file_size for _, file_size, _ in files)
+        if _cache_size <= settings.PHOTO_CACHE_MAX_SIZE:
+            return
+
+        # Make some room, so that we don't have to do this again on the next write
+        target = settings.PHOTO_CACHE_MAX_SIZE * 0.9
+        for _, file_size, path in sorted(files):
+            if _cache_size <= target:
+                break
+            if path == added_path:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            _cache_size -= file_size
+
+
+def remove_photo_variants(sender, instance, **kwargs):
+    shutil.rmtree(os.path.join(settings.PHOTO_CACHE_ROOT, str(instance.pk)), ignore_errors=True)
+
+post_delete.connect(remove_photo_variants, sender=Photo)
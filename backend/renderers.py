@@ -0,0 +1,40 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from backend.markers import markers_binary, markers_geojson
+
+
+def is_error(renderer_context):
+    response = (renderer_context or {}).get('response')
+    return response is not None and response.exception
+
+
+class GeoJSONMarkerRenderer(JSONRenderer):
+    """
+    Renders the marker columns of backend.markers as GeoJSON
+    """
+
+    media_type = 'application/geo+json'
+    format = 'geojson'
+    # Much faster to encode on Python 2 for the number of strings in a big collection
+    ensure_ascii = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not is_error(renderer_context):
+            data = markers_geojson(data)
+        return super(GeoJSONMarkerRenderer, self).render(data, accepted_media_type, renderer_context)
+
+
+class BinaryMarkerRenderer(BaseRenderer):
+    """
+    Renders the marker columns of backend.markers packed by markers_binary(). Errors are still rendered as JSON.
+    """
+
+    media_type = 'application/octet-stream'
+    format = 'bin'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if is_error(renderer_context):
+            return JSONRenderer().render(data)
+        return markers_binary(data)
@@ -0,0 +1,121 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_save, post_delete
+from django.utils.module_loading import import_string
+
+from backend.models import Place
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_words(query):
+    return WORD_RE.findall(query or '')
+
+
+class SearchBackend(object):
+    """
+    Keeps a full-text index of place names and descriptions. Set SEARCH_BACKEND to the dotted path of a subclass
+    to use another database.
+    """
+
+    def create_index(self, cursor):
+        raise NotImplementedError
+
+    def drop_index(self, cursor):
+        raise NotImplementedError
+
+    def index_places(self, cursor, places):
+        """
+        Adds or replaces (id, name, description) of places in the index
+        """
+        raise NotImplementedError
+
+    def remove_places(self, cursor, place_ids):
+        raise NotImplementedError
+
+    def search(self, queryset, words):
+        """
+        Limits the queryset to places matching all the words (as prefixes) and annotates them with a search_rank,
+        lower is better
+        """
+        raise NotImplementedError
+
+    def rebuild(self, cursor, places):
+        self.drop_index(cursor)
+        self.create_index(cursor)
+        self.index_places(cursor, places)
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    An FTS5 table with a row for each place, the rowid being the id of the place
+    """
+
+    table = 'backend_place_fts'
+    # Matches in the name count ten times as much as in the description
+    rank = 'bm25(%s, 10.0, 1.0)' % table
+
+    def create_index(self, cursor):
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(name, description, "
+                       "tokenize='unicode61 remove_diacritics 1')" % self.table)
+
+    def drop_index(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' % self.table)
+
+    def index_places(self, cursor, places):
+        places = list(places)
+        self.remove_places(cursor, [place[0] for place in places])
+        cursor.executemany('INSERT INTO %s (rowid, name, description) VALUES (%%s, %%s, %%s)' % self.table, places)
+
+    def remove_places(self, cursor, place_ids):
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.table, [(place_id,) for place_id in place_ids])
+
+    @staticmethod
+    def match_expression(words):
+        # Every word is quoted so that it's never taken for an FTS operator, the * makes it a prefix
+        return ' '.join('"%s"*' % word for word in words)
+
+    def search(self, queryset, words):
+        match = self.match_expression(words)
+        pk = '"%s"."%s"' % (queryset.model._meta.db_table, queryset.model._meta.pk.column)
+        queryset = queryset.extra(
+            where=['%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (pk, self.table, self.table)],
+            params=[match],
+        )
+        return queryset.annotate(search_rank=RawSQL(
+            'SELECT %s FROM %s WHERE %s MATCH %%s AND rowid = %s' % (self.rank, self.table, self.table, pk),
+            [match], output_field=FloatField()))
+
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(getattr(settings, 'SEARCH_BACKEND', 'backend.search.SQLiteSearchBackend'))()
+    return _backend
+
+
+def rebuild_search_index():
+    places = Place.objects.values_list('pk', 'name', 'description')
+    with connection.cursor() as cursor:
+        get_search_backend().rebuild(cursor, places.iterator())
+    return places.count()
+
+
+def index_place(sender, instance, **kwargs):
+    with connection.cursor() as cursor:
+        get_search_backend().index_places(cursor, [(instance.pk, instance.name, instance.description)])
+
+
+def remove_place(sender, instance, **kwargs):
+    with connection.cursor() as cursor:
+        get_search_backend().remove_places(cursor, [instance.pk])
+
+post_save.connect(index_place, sender=Place)
+post_delete.connect(remove_place, sender=Place)
@@ -1,21 +1,101 @@
 import logging
+from collections import OrderedDict
 
 import six
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import Point
-from django.db.models import Avg
+from django.db import models
+from django.urls import get_script_prefix, get_urlconf, reverse as django_reverse
+from django.utils.functional import cached_property
 from rest_framework import fields
 from rest_framework import serializers
+from rest_framework.relations import Hyperlink
+from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
+
+from backend.bulk import bulk_create_places
+from backend.fragments import place_representations
+from backend.models import Place, Photo, Tag, Visit, PHOTO_READY, PHOTO_PENDING
+from backend.photo_cache import PHOTO_SIZES, PHOTO_TYPES
+
+
+# Stands for the lookup value when a url is reversed into a template, digits match any lookup pattern
+URL_PLACEHOLDER = '9876543210'
+
+# {(urlconf, script prefix, view name, lookup kwarg): path with URL_PLACEHOLDER}
+_url_paths = {}
+
+
+def url_template(request, view_name, lookup_url_kwarg):
+    """
+    Returns the absolute url of the view with %d in place of the lookup value. The view is reversed once per process,
+    the host is added once per request.
+    """
+    templates = getattr(request, '_url_templates', None)
+    if templates is None:
+        templates = request._url_templates = {}
+
+    key = (view_name, lookup_url_kwarg)
+    if key not in templates:
+        path_key = (get_urlconf(), get_script_prefix()) + key
+        if path_key not in _url_paths:
+            _url_paths[path_key] = django_reverse(view_name, kwargs={lookup_url_kwarg: URL_PLACEHOLDER})
+        url = request.build_absolute_uri(_url_paths[path_key])
+        templates[key] = url.replace('%', '%%').replace(URL_PLACEHOLDER, '%d')
+    return templates[key]
+
+
+class LazyHyperlink(Hyperlink):
+    """
+    Hyperlink which only computes its name, shown by the browsable API, when it's used
+    """
+
+    def __new__(cls, url, obj, field):
+        ret = six.text_type.__new__(cls, url)
+        ret.obj = obj
+        ret.field = field
+        return ret
+
+    @property
+    def name(self):
+        return self.field.get_name(self.obj)
+
+    def __reduce__(self):
+        return Hyperlink, (six.text_type(self), self.name)
+
+
+class URLTemplateMixin(object):
+    """
+    Fills the lookup value into a url_template() instead of reversing the view for every object. The urls are the
+    same as the ones reverse() gives, which is still used when they could differ.
+    """
+
+    def get_url(self, obj, view_name, request, format):
+        lookup_value = getattr(obj, self.lookup_field, None)
+        if (format is not None or request is None or getattr(request, 'versioning_scheme', None) is not None or
+                api_settings.URL_FORMAT_OVERRIDE in request.GET or
+                not isinstance(lookup_value, six.integer_types) or isinstance(lookup_value, bool)):
+            return super(URLTemplateMixin, self).get_url(obj, view_name, request, format)
+        return url_template(request, view_name, self.lookup_url_kwarg) % lookup_value
 
-from backend.models import Place, Photo, Tag, Visit
+    def to_representation(self, value):
+        # Like HyperlinkedRelatedField.to_representation(), without computing the name
+        format = self.context.get('format', None)
+        if format and self.format and self.format != format:
+            format = self.format
+
+        url = self.get_url(value, self.view_name, self.context['request'], format)
+        if url is None:
+            return None
+        return LazyHyperlink(url, value, self)
 
 
 # TODO: HyperlinkedIdentityField and HyperlinkedRelatedField have some problems with utf-8 which look like a bug in Django REST Framework
 # We'll use these class as a temporary fix
-class FixedHyperlinkedIdentityField(serializers.HyperlinkedIdentityField):
+class FixedHyperlinkedIdentityField(URLTemplateMixin, serializers.HyperlinkedIdentityField):
     def get_name(self, obj):
         return six.text_type(str(obj), 'utf-8')
-class FixedHyperlinkedRelatedField(serializers.HyperlinkedRelatedField):
+class FixedHyperlinkedRelatedField(URLTemplateMixin, serializers.HyperlinkedRelatedField):
     def get_name(self, obj):
         return six.text_type(str(obj), 'utf-8')
 
@@ -28,6 +108,63 @@ class LatLngField(fields.Field):
         return Point(data[1], data[0])
 
 
+def query_param_set(request, param):
+    return set(name.strip() for name in request.query_params.get(param, '').split(',') if name.strip())
+
+
+def field_requested(request, name):
+    """
+    Tells if a field is part of the response of a serializer with SparseFieldsMixin
+    """
+    fields = query_param_set(request, 'fields')
+    return not fields or name in fields
+
+
+class SparseFieldsMixin(object):
+    """
+    Lets clients pick the fields of the response with ?fields=a,b and opt into the representations listed in
+    expandable_fields with ?expand=c. Fields that are left out are never evaluated, so they cost nothing.
+
+    Only the top level serializer of a response is affected, and only when reading, unless all_fields is set
+    in the context.
+    """
+
+    # {field name: function returning the field used when the field is expanded}
+    expandable_fields = {}
+
+    @property
+    def is_root(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def sparse_param(self, param):
+        request = self.context.get('request')
+        if request is None or not self.is_root or self.context.get('all_fields'):
+            return set()
+        return query_param_set(request, param)
+
+    @property
+    def expanded_fields(self):
+        return self.sparse_param('expand') & set(self.expandable_fields)
+
+    @cached_property
+    def _readable_fields(self):
+        only = self.sparse_param('fields')
+        expanded = self.expanded_fields
+
+        readable = []
+        for name, field in self.fields.items():
+            if field.write_only or (only and name not in only):
+                continue
+            if name in expanded:
+                field = self.expandable_fields[name]()
+                field.bind(field_name=name, parent=self)
+            readable.append(field)
+        return readable
+
+
 class TagNameSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tag
@@ -36,34 +173,55 @@ class TagNameSerializer(serializers.ModelSerializer):
         return instance.name
 
     def to_internal_value(self, data):
+        if not isinstance(data, six.string_types):
+            raise serializers.ValidationError('Tag names have to be strings.')
         return data
 
 
 class TagSerializer(serializers.HyperlinkedModelSerializer):
     url = FixedHyperlinkedIdentityField(view_name='tag-detail')
-    place_count = serializers.ReadOnlyField(source='place_set.count')
+    place_count = serializers.ReadOnlyField()
+    subtree_place_count = serializers.ReadOnlyField()
     parent = TagNameSerializer()
 
     class Meta:
         model = Tag
-        fields = ('url', 'name', 'place_count', 'parent')
+        fields = ('url', 'name', 'place_count', 'subtree_place_count', 'parent')
+
+
+class AuthorSerializer(serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = User
+        fields = ('url', 'username', 'first_name', 'last_name')
 
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     first_login = fields.ReadOnlyField(source='userprofile.first_login')
     followed_tags = TagNameSerializer(source='userprofile.followed_tags', many=True)
     saved_places = FixedHyperlinkedRelatedField(view_name='place-detail', source='userprofile.saved_places', many=True, read_only=True)
 
+    expandable_fields = {
+        'followed_tags': lambda: TagSerializer(source='userprofile.followed_tags', many=True, read_only=True),
+    }
+
+    # Only shown to the user themselves
+    private_fields = ('followed_tags', 'saved_places')
+
     class Meta:
         model = User
         fields = ('url', 'username', 'first_login', 'first_name', 'last_name', 'followed_tags', 'saved_places')
 
     def to_representation(self, instance):
-        data = super(UserSerializer, self).to_representation(instance)
-        if self.context['request'].user != instance:
-            del data['followed_tags']
-            del data['saved_places']
-        return data
+        if self.context['request'].user == instance:
+            return super(UserSerializer, self).to_representation(instance)
+
+        # Leave the private fields out before they're evaluated
+        readable_fields = self._readable_fields
+        self._readable_fields = [field for field in readable_fields if field.field_name not in self.private_fields]
+        try:
+            return super(UserSerializer, self).to_representation(instance)
+        finally:
+            self._readable_fields = readable_fields
 
     def create(self, validated_data):
         raise NotImplementedError('No creation via JSON')
@@ -84,6 +242,20 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
         return instance
 
 
+def photo_variants(request, photo):
+    """
+    Lists the urls of the sizes and formats a photo can be downloaded in. The url without a format picks WebP
+    if the Accept header allows it.
+    """
+    variant_url = url_template(request, 'photo-variant', 'pk') % photo.pk
+    variants = OrderedDict()
+    for size, max_size in PHOTO_SIZES.items():
+        variants[size] = OrderedDict([('max_size', max_size), ('url', '%s?size=%s' % (variant_url, size))])
+        for image_type in PHOTO_TYPES:
+            variants[size][image_type] = '%s?size=%s&type=%s' % (variant_url, size, image_type)
+    return variants
+
+
 class PhotoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Photo
@@ -95,69 +267,162 @@ class PhotoSerializer(serializers.ModelSerializer):
         raise NotImplementedError('TODO')
 
 
+class PhotoDetailSerializer(serializers.HyperlinkedModelSerializer):
+    url = FixedHyperlinkedIdentityField(view_name='photo-detail')
+    place = FixedHyperlinkedRelatedField(view_name='place-detail', read_only=True)
+    resized = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Photo
+        fields = ('url', 'id', 'place', 'status', 'photo', 'resized', 'variants')
+        read_only_fields = ('status', 'photo')
+
+    def get_resized(self, instance):
+        if instance.status != PHOTO_READY:
+            return None
+        return self.context['request'].build_absolute_uri(instance.photo.resized.url)
+
+    def get_variants(self, instance):
+        if instance.status != PHOTO_READY:
+            return None
+        return photo_variants(self.context['request'], instance)
+
+
 class VisitSerializer(serializers.HyperlinkedModelSerializer):
-    url = serializers.HyperlinkedRelatedField(view_name='place-visit', source='place', read_only=True)
+    url = FixedHyperlinkedRelatedField(view_name='place-visit', source='place', read_only=True)
 
     class Meta:
         model = Visit
         fields = ('url', 'date_visited', 'rating')
 
 
-class PlaceSerializer(serializers.HyperlinkedModelSerializer):
+class PlaceListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        places = data.all() if isinstance(data, models.Manager) else data
+        return place_representations(self.child, list(places))
+
+    def create(self, validated_data):
+        tags = [attrs.pop('tags') for attrs in validated_data]
+        return bulk_create_places([Place(**attrs) for attrs in validated_data], tags)
+
+
+class PlaceSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     url = FixedHyperlinkedIdentityField(view_name='place-detail')
     author = serializers.ReadOnlyField(source='author.username')
     coords = LatLngField()
-    photos = PhotoSerializer(many=True, read_only=True)
+    photos = serializers.SerializerMethodField()
+    photo_variants = serializers.SerializerMethodField()
+    photos_pending = serializers.SerializerMethodField()
     photo_upload = FixedHyperlinkedIdentityField(view_name='place-photo-upload')
     tags = TagNameSerializer(many=True)
     visit_url = FixedHyperlinkedIdentityField(view_name='place-visit')
     visit = serializers.SerializerMethodField()
-    rating_avg = serializers.SerializerMethodField()
-    rating_count = serializers.SerializerMethodField()
-    visit_count = serializers.ReadOnlyField(source='visits.count')
+    rating_avg = serializers.ReadOnlyField()
+    rating_count = serializers.ReadOnlyField()
+    visit_count = serializers.ReadOnlyField()
     save_url = FixedHyperlinkedIdentityField(view_name='place-save')
 
+    expandable_fields = {
+        'author': lambda: AuthorSerializer(read_only=True),
+        'tags': lambda: TagSerializer(many=True, read_only=True),
+    }
+
+    _sharing = False
+
+    def get_prefetch_lookups(self):
+        """
+        Returns what has to be prefetched for the fields in the response
+        """
+        names = set(field.field_name for field in self._readable_fields)
+        lookups = set()
+        if 'author' in names:
+            lookups.add('author')
+        if 'photos' in names or 'photo_variants' in names or 'photos_pending' in names:
+            lookups.add('photos')
+        if 'tags' in names:
+            lookups.add('tags__parent' if 'tags' in self.expanded_fields else 'tags')
+        return lookups
+
+    def to_representation(self, instance):
+        return place_representations(self, [instance])[0]
+
+    def shared_representation(self, instance):
+        """
+        Returns the representation without the visit of the current user, so it can be cached for everyone
+        """
+        self._sharing = True
+        try:
+            return super(PlaceSerializer, self).to_representation(instance)
+        finally:
+            self._sharing = False
+
+    # Photos still being processed in the background don't have their variations yet
+
+    def get_photos(self, instance):
+        photos = [photo for photo in instance.photos.all() if photo.status == PHOTO_READY]
+        return PhotoSerializer(photos, many=True, context=self.context).data
+
+    def get_photo_variants(self, instance):
+        # In the same order as photos
+        request = self.context['request']
+        return [photo_variants(request, photo) for photo in instance.photos.all() if photo.status == PHOTO_READY]
+
+    def get_photos_pending(self, instance):
+        return len([photo for photo in instance.photos.all() if photo.status == PHOTO_PENDING])
+
     def get_visit(self, instance):
-        if not self.context['request'].user.is_authenticated():
+        if self._sharing or not self.context['request'].user.is_authenticated():
             return None
 
+        # Prefetched by PlaceViewSet.get_queryset(), fall back to a query for instances that didn't come from there
+        if hasattr(instance, 'user_visits'):
+            if not instance.user_visits:
+                return None
+            return VisitSerializer(instance.user_visits[0], context=self.context).data
+
         try:
             visit = Visit.objects.get(place=instance, visitor=self.context['request'].user)
             return VisitSerializer(visit, context=self.context).data
         except Visit.DoesNotExist:
             return None
 
-    def get_rating_avg(self, instance):
-        return instance.visits.exclude(rating=0).aggregate(Avg('rating'))['rating__avg']
-
-    def get_rating_count(self, instance):
-        return instance.visits.exclude(rating=0).count()
-
     class Meta:
         model = Place
-        fields = ('url', 'name', 'description', 'author', 'date_created', 'date_modified', 'coords', 'photos', 'photo_upload', 'tags', 'visit_url', 'visit', 'rating_avg', 'rating_count', 'visit_count', 'save_url')
+        fields = ('url', 'name', 'description', 'author', 'date_created', 'date_modified', 'coords', 'photos', 'photo_variants', 'photos_pending', 'photo_upload', 'tags', 'visit_url', 'visit', 'rating_avg', 'rating_count', 'visit_count', 'save_url')
+        list_serializer_class = PlaceListSerializer
+
+    def validate_tags(self, names):
+        """
+        Resolves the names into tags. Batches of places resolve all their tags up front, see PlaceViewSet.batch()
+        """
+        tags_by_name = self.context.get('tags_by_name')
+        if tags_by_name is None:
+            tags_by_name = dict((tag.name, tag) for tag in Tag.objects.filter(name__in=names))
+        unknown = [name for name in names if name not in tags_by_name]
+        if unknown:
+            raise serializers.ValidationError('Unknown tags: ' + ', '.join(unknown))
+        return [tags_by_name[name] for name in names]
 
     def create(self, validated_data):
-        tags = validated_data['tags']
-        del validated_data['tags']
-
+        tags = validated_data.pop('tags')
         instance = Place.objects.create(**validated_data)
-
-        for tagname in tags:
-            instance.tags.add(Tag.objects.get(name=tagname))
-
-        instance.save()
+        instance.tags.add(*tags)
         return instance
 
     def update(self, instance, validated_data):
+        tags = validated_data.pop('tags', None)
         for attr, value in validated_data.items():
-            if attr == 'tags':
-                continue
             setattr(instance, attr, value)
 
-        instance.tags.clear()
-        for tagname in validated_data['tags']:
-            instance.tags.add(Tag.objects.get(name=tagname))
+        if tags is not None:
+            # Only the tags that actually changed are touched
+            old_ids = set(instance.tags.values_list('pk', flat=True))
+            new_ids = set(tag.pk for tag in tags)
+            if old_ids - new_ids:
+                instance.tags.remove(*(old_ids - new_ids))
+            if new_ids - old_ids:
+                instance.tags.add(*(new_ids - old_ids))
         instance.save()
 
         return instance
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Prefetch, Q
+from django.db.models.signals import post_delete
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.reverse import reverse
+
+from backend.db.routers import reads_from_primary
+from backend.models import Place, Photo, Tag, Tombstone, UserProfile, Visit
+from backend.serializers import PhotoDetailSerializer, PlaceSerializer, TagSerializer, VisitSerializer
+
+EPOCH = timezone.make_aware(datetime(1970, 1, 1), timezone.utc)
+
+# Tombstone.model for each deleted object, and the view of its url
+TOMBSTONE_VIEWS = (
+    ('place', 'place-detail'),
+    ('photo', 'photo-detail'),
+    ('tag', 'tag-detail'),
+    ('visit', 'place-visit'),
+)
+
+
+def encode_token(date):
+    delta = date - EPOCH
+    return '%d' % ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def decode_token(token):
+    try:
+        return EPOCH + timedelta(microseconds=int(token))
+    except (ValueError, OverflowError):
+        raise exceptions.ParseError('Invalid sync token')
+
+
+def changed_querysets(user, since):
+    """
+    Returns {name: queryset} of everything the user has to know about that changed after since
+    """
+    return {
+        'places': Place.objects.filter(date_modified__gt=since),
+        'photos': Photo.objects.filter(date_modified__gt=since),
+        'tags': Tag.objects.filter(date_modified__gt=since),
+        'visits': Visit.objects.filter(visitor=user, date_modified__gt=since),
+        'profile': UserProfile.objects.filter(user=user, date_modified__gt=since),
+        'tombstones': Tombstone.objects.filter(Q(user=None) | Q(user=user), date_deleted__gt=since),
+    }
+
+
+def any_exists(querysets):
+    """
+    Tells if any of the querysets has a row, in a single query of EXISTS clauses that only touch the indexes
+    """
+    queries = [queryset.order_by().values('pk')[:1].query.sql_with_params() for queryset in querysets]
+    sql = 'SELECT ' + ' OR '.join('EXISTS (%s)' % query for query, _ in queries)
+    params = [param for _, query_params in queries for param in query_params]
+    with connections[querysets[0].db].cursor() as cursor:
+        cursor.execute(sql, params)
+        return bool(cursor.fetchone()[0])
+
+
+@reads_from_primary
+def sync_data(request, since=None):
+    """
+    Returns everything that changed after the since sync token, or everything when it's None, with a new token.
+
+    Changes made a few seconds before a sync (SYNC_OVERLAP) are included again in the following one, in case they
+    were committed after it, so clients have to expect the same changes twice. A replica can be behind by more
+    than that, and what it's missing would never be synced, so everything is read from the primary.
+    """
+    user = request.user
+    now = timezone.now()
+    token = encode_token(now - timedelta(seconds=settings.SYNC_OVERLAP))
+
+    reset = since is not None and since < now - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+    if since is None or reset:
+        # The tombstones since then could be gone, start over
+        since = EPOCH
+
+    data = {
+        'sync_token': token,
+        'reset': reset,
+        'places': [],
+        'photos': [],
+        'tags': [],
+        'visits': [],
+        # Saved places are always listed in full, when anything about them changed
+        'saved_places': None,
+        'deleted': dict((model + 's', []) for model, _ in TOMBSTONE_VIEWS),
+    }
+    querysets = changed_querysets(user, since)
+    if since != EPOCH and not any_exists(list(querysets.values())):
+        return data
+
+    context = {'request': request}
+    places = querysets['places'].prefetch_related(
+        Prefetch('visits', queryset=Visit.objects.filter(visitor=user), to_attr='user_visits'))
+    data['places'] = PlaceSerializer(places, many=True, context=context).data
+    data['photos'] = PhotoDetailSerializer(querysets['photos'], many=True, context=context).data
+    data['tags'] = TagSerializer(querysets['tags'].select_related('parent'), many=True, context=context).data
+    data['visits'] = VisitSerializer(querysets['visits'], many=True, context=context).data
+
+    if querysets['profile'].exists():
+        data['saved_places'] = [
+            reverse('place-detail', kwargs={'pk': pk}, request=request)
+            for pk in user.userprofile.saved_places.values_list('pk', flat=True)
+        ]
+
+    if since == EPOCH:
+        return data
+    views = dict(TOMBSTONE_VIEWS)
+    for model, object_id in querysets['tombstones'].values_list('model', 'object_id'):
+        data['deleted'][model + 's'].append(reverse(views[model], kwargs={'pk': object_id}, request=request))
+    return data
+
+
+def purge_tombstones():
+    """
+    Deletes the tombstones no sync needs anymore, returns how many
+    """
+    cutoff = timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+    count, _ = Tombstone.objects.filter(date_deleted__lt=cutoff).delete()
+    return count
+
+
+def object_deleted(sender, instance, **kwargs):
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.pk)
+
+
+def visit_deleted(sender, instance, **kwargs):
+    # Visits are identified by their place
+    Tombstone.objects.create(model='visit', object_id=instance.place_id, user_id=instance.visitor_id)
+
+post_delete.connect(object_deleted, sender=Place)
+post_delete.connect(object_deleted, sender=Photo)
+post_delete.connect(object_deleted, sender=Tag)
+post_delete.connect(visit_deleted, sender=Visit)
@@ -0,0 +1,159 @@
+from collections import defaultdict, Counter
+
+from django.db.models import CharField, F, Q, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.utils import timezone
+
+from backend.models import Place, Tag
+
+PlaceTag = Place.tags.through
+
+
+def path_ids(path):
+    return [int(i) for i in path.split('/') if i]
+
+
+def subtree_filter(path, field='path'):
+    """
+    Matches the paths of a tag and its descendants.
+
+    Paths consist of digits and slashes only, so all of them sort between the path itself and the path with its
+    trailing slash replaced by '0'. Unlike a LIKE 'path%' lookup, the range can always use the index.
+    """
+    return Q(**{field + '__gte': path, field + '__lt': path[:-1] + '0'})
+
+
+def tag_snapshot(place_ids):
+    """
+    Returns {place id: (ids of its tags, ids of its tags and all their ancestors)}
+    """
+    snapshot = dict((place_id, (set(), set())) for place_id in place_ids)
+    for place_id, tag_id, path in PlaceTag.objects.filter(place_id__in=place_ids).values_list('place_id', 'tag_id', 'tag__path'):
+        snapshot[place_id][0].add(tag_id)
+        snapshot[place_id][1].update(path_ids(path))
+    return snapshot
+
+
+def update_tag_counts(before, after):
+    """
+    Updates the place counts of tags according to the difference between two tag_snapshot()s
+    """
+    deltas = defaultdict(lambda: [0, 0])
+    for place_id, (old_tags, old_subtrees) in before.items():
+        new_tags, new_subtrees = after.get(place_id, (set(), set()))
+        for tag_id in new_tags - old_tags:
+            deltas[tag_id][0] += 1
+        for tag_id in old_tags - new_tags:
+            deltas[tag_id][0] -= 1
+        for tag_id in new_subtrees - old_subtrees:
+            deltas[tag_id][1] += 1
+        for tag_id in old_subtrees - new_subtrees:
+            deltas[tag_id][1] -= 1
+
+    tags_by_delta = defaultdict(list)
+    for tag_id, delta in deltas.items():
+        if delta != [0, 0]:
+            tags_by_delta[tuple(delta)].append(tag_id)
+    for (direct, subtree), tag_ids in tags_by_delta.items():
+        Tag.objects.filter(pk__in=tag_ids).update(
+            place_count=F('place_count') + direct, subtree_place_count=F('subtree_place_count') + subtree,
+            date_modified=timezone.now())
+
+
+def recount_subtrees(tag_ids):
+    for tag_id, path in Tag.objects.filter(pk__in=tag_ids).values_list('pk', 'path'):
+        count = PlaceTag.objects.filter(subtree_filter(path, 'tag__path')).values('place_id').distinct().count()
+        Tag.objects.filter(pk=tag_id).update(subtree_place_count=count, date_modified=timezone.now())
+
+
+def rebuild_tag_tree():
+    """
+    Recomputes the paths and place counts of all tags from scratch
+    """
+    children = defaultdict(list)
+    current = {}
+    for tag_id, parent_id, path, place_count, subtree_place_count in Tag.objects.values_list(
+            'pk', 'parent_id', 'path', 'place_count', 'subtree_place_count'):
+        children[parent_id].append(tag_id)
+        current[tag_id] = (path, place_count, subtree_place_count)
+
+    paths = {}
+    stack = [(tag_id, '/') for tag_id in children[None]]
+    while stack:
+        tag_id, parent_path = stack.pop()
+        paths[tag_id] = '%s%d/' % (parent_path, tag_id)
+        stack.extend((child_id, paths[tag_id]) for child_id in children[tag_id])
+
+    place_counts = Counter()
+    subtree_places = defaultdict(set)
+    for place_id, tag_id in PlaceTag.objects.values_list('place_id', 'tag_id'):
+        place_counts[tag_id] += 1
+        for ancestor_id in path_ids(paths.get(tag_id, '')):
+            subtree_places[ancestor_id].add(place_id)
+
+    now = timezone.now()
+    for tag_id, path in paths.items():
+        values = (path, place_counts[tag_id], len(subtree_places[tag_id]))
+        if values != current[tag_id]:
+            Tag.objects.filter(pk=tag_id).update(
+                path=path, place_count=values[1], subtree_place_count=values[2], date_modified=now)
+    return len(paths)
+
+
+def remember_tag_path(sender, instance, **kwargs):
+    instance._old_path = None
+    if instance.pk is not None:
+        instance._old_path = Tag.objects.filter(pk=instance.pk).values_list('path', flat=True).first()
+
+
+def update_tag_path(sender, instance, **kwargs):
+    parent_path = '/'
+    if instance.parent_id is not None:
+        parent_path = Tag.objects.filter(pk=instance.parent_id).values_list('path', flat=True).get()
+    old_path, new_path = instance._old_path, '%s%d/' % (parent_path, instance.pk)
+    if old_path == new_path:
+        return
+
+    Tag.objects.filter(pk=instance.pk).update(path=new_path)
+    instance.path = new_path
+    if not old_path:
+        return
+
+    # The tag was moved together with its descendants
+    Tag.objects.filter(subtree_filter(old_path)).exclude(pk=instance.pk).update(
+        path=Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=CharField()))
+    recount_subtrees(set(path_ids(old_path) + path_ids(new_path)) - {instance.pk})
+
+
+def recount_tag_ancestors(sender, instance, **kwargs):
+    recount_subtrees(set(path_ids(instance.path)) - {instance.pk})
+
+
+def place_tags_changing(sender, instance, action, reverse, pk_set, **kwargs):
+    if action.startswith('pre_'):
+        if not reverse:
+            place_ids = [instance.pk]
+        elif pk_set is not None:
+            place_ids = list(pk_set)
+        else:
+            place_ids = list(PlaceTag.objects.filter(tag_id=instance.pk).values_list('place_id', flat=True))
+        instance._tag_snapshot = tag_snapshot(place_ids)
+    else:
+        before = instance._tag_snapshot
+        update_tag_counts(before, tag_snapshot(list(before)))
+
+
+def place_deleting(sender, instance, **kwargs):
+    instance._tag_snapshot = tag_snapshot([instance.pk])
+
+
+def place_deleted(sender, instance, **kwargs):
+    update_tag_counts(instance._tag_snapshot, {})
+
+pre_save.connect(remember_tag_path, sender=Tag)
+post_save.connect(update_tag_path, sender=Tag)
+post_delete.connect(recount_tag_ancestors, sender=Tag)
+m2m_changed.connect(place_tags_changing, sender=PlaceTag)
+pre_delete.connect(place_deleting, sender=Place)
+post_delete.connect(place_deleted, sender=Place)
@@ -0,0 +1,35 @@
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from backend.conditional import touch_places
+from backend.images import render_photo_variations
+from backend.jobs import enqueue
+from backend.models import Photo, PHOTO_READY, PHOTO_FAILED
+
+
+def render_photo(photo_id):
+    """
+    Fixes the orientation of an uploaded photo and renders its variations
+    """
+    try:
+        photo = Photo.objects.get(pk=photo_id)
+    except Photo.DoesNotExist:
+        return  # deleted in the meantime
+
+    render_photo_variations(photo.photo.name, photo.photo.field.variations, photo.photo.storage)
+    Photo.objects.filter(pk=photo_id).update(status=PHOTO_READY, date_modified=timezone.now())
+    # The photo appears in the place now
+    touch_places(photos=photo_id)
+
+
+def render_photo_failed(photo_id):
+    Photo.objects.filter(pk=photo_id).update(status=PHOTO_FAILED, date_modified=timezone.now())
+
+render_photo.on_failure = render_photo_failed
+
+
+def enqueue_photo_rendering(sender, instance, created, **kwargs):
+    if created:
+        enqueue('backend.tasks.render_photo', instance.pk)
+
+post_save.connect(enqueue_photo_rendering, sender=Photo)
@@ -1,3 +1,410 @@
-from django.test import TestCase
+import base64
+import json
+import time
+from collections import OrderedDict
+from datetime import timedelta
 
-# Create your tests here.
+import mock
+import six
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Avg, Count
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from backend.db.routers import LagMonitor, ReplicaMiddleware, ReplicaRouter, pin_cache, reads_from_primary
+from backend.filters import bbox_around, parse_bbox, split_bbox
+from backend.google_auth import InvalidToken, StaticKeySource, verify_id_token
+from backend.models import Place, Tag, Visit
+from backend.serializers import FixedHyperlinkedIdentityField, PlaceSerializer
+from backend.sync import sync_data
+
+AUDIENCE = 'client-id.apps.googleusercontent.com'
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(force_bytes(data)).rstrip(b'=')
+
+
+class VerifyIdTokenTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(VerifyIdTokenTests, cls).setUpClass()
+        cls.private_key = RSA.generate(1024)
+        cls.key_source = StaticKeySource({'test': cls.private_key.publickey()})
+
+    def sign(self, kid='test', **claims):
+        claims = dict({'iss': 'https://accounts.google.com', 'aud': AUDIENCE, 'sub': '42',
+                       'exp': int(time.time()) + 3600}, **claims)
+        signed = b64encode(json.dumps({'alg': 'RS256', 'kid': kid})) + b'.' + b64encode(json.dumps(claims))
+        signature = PKCS1_v1_5.new(self.private_key).sign(SHA256.new(signed))
+        return signed + b'.' + b64encode(signature)
+
+    def assertInvalid(self, token, message):
+        with six.assertRaisesRegex(self, InvalidToken, message):
+            verify_id_token(token, AUDIENCE, self.key_source)
+
+    def test_valid_token(self):
+        claims = verify_id_token(self.sign(), AUDIENCE, self.key_source)
+        self.assertEqual(claims['sub'], '42')
+
+    def test_invalid_issuer(self):
+        self.assertInvalid(self.sign(iss='https://evil.example.com'), 'issuer')
+
+    def test_invalid_audience(self):
+        self.assertInvalid(self.sign(aud='someone-else'), 'not meant for this app')
+
+    def test_expired(self):
+        self.assertInvalid(self.sign(exp=int(time.time()) - 3600), 'expired')
+
+    def test_missing_expiry(self):
+        self.assertInvalid(self.sign(exp=None), 'expiry')
+
+    def test_unknown_key(self):
+        self.assertInvalid(self.sign(kid='other'), 'Unknown signing key')
+
+    def test_tampered_claims(self):
+        header, _, signature = self.sign().split(b'.')
+        payload = b64encode(json.dumps({'iss': 'accounts.google.com', 'aud': AUDIENCE, 'sub': '1',
+                                        'exp': int(time.time()) + 3600}))
+        self.assertInvalid(b'.'.join([header, payload, signature]), 'Invalid signature')
+
+    def test_key_source_from_settings(self):
+        public_key = self.private_key.publickey().exportKey().decode('ascii')
+        with override_settings(GOOGLE_KEY_SOURCE='backend.google_auth.StaticKeySource',
+                               GOOGLE_KEY_SOURCE_OPTIONS={'keys': {'test': public_key}}):
+            claims = verify_id_token(self.sign(), AUDIENCE)
+        self.assertEqual(claims['sub'], '42')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_SELECTION='round-robin', REPLICA_PIN_SECONDS=10,
+                   REPLICA_PIN_CACHE_ALIAS='default')
+class ReplicaRouterTests(SimpleTestCase):
+    # transaction.atomic() opens the test database
+    allow_database_queries = True
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+        pin_cache().clear()
+
+    def request(self, method='get', view=None, **extra):
+        """
+        Runs view through ReplicaMiddleware in a request, returns where it read from
+        """
+        reads = []
+
+        def get_response(request):
+            if view is not None:
+                view()
+            reads.append(self.router.db_for_read(Place))
+            return HttpResponse()
+
+        ReplicaMiddleware(get_response)(getattr(self.factory, method)('/places/', **extra))
+        return reads[0]
+
+    def test_safe_requests_read_from_replicas(self):
+        self.assertEqual(self.request(), 'replica')
+        self.assertEqual(self.request('head'), 'replica')
+
+    @override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+    def test_requests_read_from_one_replica(self):
+        reads = []
+
+        def view():
+            reads.extend(self.router.db_for_read(Place) for _ in range(3))
+        self.request(view=view)
+        self.request(view=view)
+        self.assertEqual(len(set(reads[:3])), 1)
+        self.assertEqual(len(set(reads[3:])), 1)
+        self.assertEqual(set(reads), set(['replica1', 'replica2']))
+
+    def test_other_requests_read_from_primary(self):
+        self.assertEqual(self.request('post'), 'default')
+        self.assertEqual(self.request('delete'), 'default')
+
+    def test_reads_outside_requests_use_primary(self):
+        self.assertEqual(self.router.db_for_read(Place), 'default')
+
+    def test_reads_after_write_use_primary(self):
+        self.assertEqual(self.request(view=lambda: self.router.db_for_write(Place)), 'default')
+
+    def test_reads_in_transactions_use_primary(self):
+        def view():
+            with transaction.atomic():
+                self.assertEqual(self.router.db_for_read(Place), 'default')
+        self.assertEqual(self.request(view=view), 'replica')
+
+    def test_reads_from_primary(self):
+        reads = []
+
+        @reads_from_primary
+        def view():
+            reads.append(self.router.db_for_read(Place))
+        self.assertEqual(self.request(view=view), 'replica')
+        self.assertEqual(reads, ['default'])
+
+    def test_client_is_pinned_after_write(self):
+        self.request('post', HTTP_AUTHORIZATION='Token writer')
+        self.assertEqual(self.request(HTTP_AUTHORIZATION='Token writer'), 'default')
+        self.assertEqual(self.request(HTTP_AUTHORIZATION='Token reader'), 'replica')
+
+    def test_client_is_pinned_after_write_in_safe_request(self):
+        self.request(view=lambda: self.router.db_for_write(Place), HTTP_AUTHORIZATION='Token writer')
+        self.assertEqual(self.request(HTTP_AUTHORIZATION='Token writer'), 'default')
+
+    def test_pin_expires(self):
+        with override_settings(REPLICA_PIN_SECONDS=0.1):
+            self.request('post', HTTP_AUTHORIZATION='Token writer')
+        time.sleep(0.2)
+        self.assertEqual(self.request(HTTP_AUTHORIZATION='Token writer'), 'replica')
+
+    def test_replicas_are_not_migrated(self):
+        self.assertTrue(self.router.allow_migrate('default', 'backend'))
+        self.assertFalse(self.router.allow_migrate('replica', 'backend'))
+
+
+@override_settings(REPLICA_HEARTBEAT_INTERVAL=1)
+class LagMonitorTests(SimpleTestCase):
+    def measure(self, heartbeats):
+        now = timezone.now()
+        heartbeats = dict((alias, now - timedelta(seconds=age) if age is not None else None)
+                          for alias, age in heartbeats.items())
+        with mock.patch.object(LagMonitor, 'heartbeat', side_effect=heartbeats.get):
+            return LagMonitor().measure(['replica'])['replica']
+
+    def test_lag_is_the_age_of_the_replica_heartbeat(self):
+        self.assertAlmostEqual(self.measure({'default': 0, 'replica': 7}), 7, places=2)
+
+    def test_caught_up_replica(self):
+        self.assertEqual(self.measure({'default': 0.5, 'replica': 0.5}), 0)
+
+    def test_replica_without_heartbeat(self):
+        self.assertEqual(self.measure({'default': 0, 'replica': None}), float('inf'))
+
+    def test_stopped_heartbeat(self):
+        # Even a replica with all the data can't be told apart from one that stopped replicating
+        self.assertEqual(self.measure({'default': 3600, 'replica': 3600}), float('inf'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_PIN_CACHE_ALIAS='default')
+class SyncReplicaTests(TransactionTestCase):
+    """
+    The sync token is cut from the primary's clock, so a change a lagging replica doesn't have yet would fall before
+    the next sync and never reach the client
+    """
+
+    def test_sync_reads_from_primary(self):
+        user = User.objects.create(username='syncer')
+        Place.objects.create(name='Wawel', coords=Point(19.935, 50.054))
+        pin_cache().clear()
+
+        # The test database stands in for the replica too, what matters is where the router sends the reads
+        aliases = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def recording_db_for_read(router, model, **hints):
+            aliases.append(db_for_read(router, model, **hints))
+            return DEFAULT_DB_ALIAS
+
+        def get_response(request):
+            request = Request(request)
+            request.user = user
+            self.assertEqual(len(sync_data(request)['places']), 1)
+            # The rest of the request still uses the replica
+            self.assertEqual(db_for_read(ReplicaRouter(), Place), 'replica')
+            return HttpResponse()
+
+        with mock.patch.object(ReplicaRouter, 'db_for_read', recording_db_for_read):
+            ReplicaMiddleware(get_response)(RequestFactory().get('/sync/'))
+        self.assertTrue(aliases)
+        self.assertEqual(set(aliases), set([DEFAULT_DB_ALIAS]))
+
+
+class PlaceHyperlinkTests(SimpleTestCase):
+    """
+    The url templates give the same output as reversing every url, also once the places come from the fragment cache
+    """
+
+    fields = ('url', 'name', 'photo_upload', 'visit_url', 'save_url')
+
+    def setUp(self):
+        caches[settings.PLACE_CACHE_ALIAS].clear()
+        self.place = Place(pk=12, name=u'Zamek Kr\xf3lewski', coords=Point(21.0137, 52.2479), date_modified=timezone.now())
+        self.request = Request(RequestFactory().get('/places/', {'fields': ','.join(self.fields)}))
+
+    def reversed_representation(self):
+        kwargs = {'pk': self.place.pk}
+        return OrderedDict([
+            ('url', reverse('place-detail', kwargs=kwargs, request=self.request)),
+            ('name', self.place.name),
+            ('photo_upload', reverse('place-photo-upload', kwargs=kwargs, request=self.request)),
+            ('visit_url', reverse('place-visit', kwargs=kwargs, request=self.request)),
+            ('save_url', reverse('place-save', kwargs=kwargs, request=self.request)),
+        ])
+
+    def assertSameOutput(self, data):
+        expected = [self.reversed_representation()]
+        self.assertEqual(JSONRenderer().render(data), JSONRenderer().render(expected))
+        # The browsable API shows the JSON indented
+        context = {'indent': 4}
+        self.assertEqual(JSONRenderer().render(data, 'application/json; indent=4', context),
+                         JSONRenderer().render(expected, 'application/json; indent=4', context))
+
+    def serialize(self):
+        return PlaceSerializer([self.place], many=True, context={'request': self.request}).data
+
+    def test_uncached(self):
+        with self.settings(PLACE_CACHE_TIMEOUT=0):
+            self.assertSameOutput(self.serialize())
+
+    def test_cached(self):
+        # Caching doesn't compute the names of the links
+        with mock.patch.object(FixedHyperlinkedIdentityField, 'get_name') as get_name:
+            self.assertSameOutput(self.serialize())
+        self.assertFalse(get_name.called)
+
+        data = self.serialize()
+        self.assertSameOutput(data)
+        name = PlaceSerializer().fields['url'].get_name(self.place)
+        for field in ('url', 'photo_upload', 'visit_url', 'save_url'):
+            self.assertEqual(data[0][field].name, name)
+
+
+class PlaceValidationTests(SimpleTestCase):
+    def test_tags_have_to_be_strings(self):
+        for tags in ([1], [None], [{}]):
+            serializer = PlaceSerializer(data={'name': 'Wawel', 'coords': [50.054, 19.935], 'tags': tags},
+                                         context={'tags_by_name': {}})
+            self.assertFalse(serializer.is_valid())
+            self.assertIn('tags', serializer.errors)
+
+
+class BboxTests(SimpleTestCase):
+    def parse(self, value):
+        return parse_bbox(Request(RequestFactory().get('/places/', {'in_bbox': value})), 'in_bbox')
+
+    def test_parse_bbox(self):
+        self.assertEqual(self.parse('52,19,50,21'), (19, 50, 21, 52))
+        # Fiji, across the antimeridian
+        self.assertEqual(split_bbox(self.parse('-19,177,-16,-179')), [(177, -19, 180, -16), (-180, -19, -179, -16)])
+
+    def test_bbox_around_wraps(self):
+        west, south, east, north = bbox_around(-17.8, 179.9, 50000)
+        self.assertTrue(west > 179 and east < -179)
+        self.assertEqual(len(split_bbox((west, south, east, north))), 2)
+
+    def test_bbox_around(self):
+        west, south, east, north = bbox_around(50.0, 20.0, 10000)
+        self.assertTrue(west < 20 < east and south < 50 < north)
+        self.assertEqual(split_bbox((west, south, east, north)), [(west, south, east, north)])
+
+
+class PlaceCursorTests(TestCase):
+    """
+    Paging through the places one at a time has to return each of them once, in the order of the whole list, with
+    every ordering the filters apply
+    """
+
+    def setUp(self):
+        caches['places'].clear()
+        tag = Tag.objects.create(name='castle')
+        # Same names on purpose, so that the search ranks tie and the ids have to break the ties
+        for name, lng in [('Zamek', 19.9), ('Zamek', 20.3), ('Zamek Zamek', 20.12), ('Zamek w lesie', 19.5),
+                          ('Ruiny zamku', 20.0)]:
+            place = Place.objects.create(name=name, coords=Point(lng, 50.0))
+            place.tags.add(tag)
+        Place.objects.create(name='Rynek', coords=Point(19.97, 50.06))
+
+    def urls(self, params):
+        response = self.client.get(reverse('place-list'), dict(params, page_size=500))
+        expected = [place['url'] for place in response.json()['results']]
+
+        urls = []
+        response = self.client.get(reverse('place-list'), dict(params, page_size=1))
+        while True:
+            data = response.json()
+            urls.extend(place['url'] for place in data['results'])
+            if data['next'] is None:
+                break
+            response = self.client.get(data['next'])
+        self.assertEqual(urls, expected)
+        return urls
+
+    def names(self, urls):
+        return [self.client.get(url).json()['name'] for url in urls]
+
+    def test_search(self):
+        urls = self.urls({'q': 'zamek'})
+        self.assertEqual(len(urls), 4)
+        self.assertEqual(self.names(urls)[0], 'Zamek Zamek')
+
+    def test_distance(self):
+        urls = self.urls({'near': '50.0,20.05', 'ordering': 'distance'})
+        self.assertEqual(self.names(urls), ['Ruiny zamku', 'Zamek Zamek', 'Rynek', 'Zamek', 'Zamek', 'Zamek w lesie'])
+
+    def test_tag(self):
+        urls = self.urls({'tag': 'castle'})
+        self.assertEqual(len(urls), 5)
+        self.assertNotIn('Rynek', self.names(urls))
+
+
+class PlaceCounterTests(TestCase):
+    """
+    The counters kept up to date with Place.counter_updates() have to match the visits, rating 0 being a visit
+    without a rating
+    """
+
+    def setUp(self):
+        caches['places'].clear()
+        self.place = Place.objects.create(name='Wawel', coords=Point(19.935, 50.054))
+        self.clients = {}
+        for username in ['ala', 'ola', 'ela']:
+            self.clients[username] = APIClient()
+            self.clients[username].force_authenticate(User.objects.create(username=username))
+
+    def visit(self, username, method, rating=None):
+        data = {} if rating is None else {'rating': rating}
+        url = reverse('place-visit', kwargs={'pk': self.place.pk})
+        response = getattr(self.clients[username], method)(url, data, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def assertCountersMatchVisits(self):
+        visits = Visit.objects.filter(place=self.place)
+        rated = visits.filter(rating__gt=0).aggregate(avg=Avg('rating'), count=Count('id'))
+        place = APIClient().get(reverse('place-detail', kwargs={'pk': self.place.pk})).json()
+        self.assertEqual(place['visit_count'], visits.count())
+        self.assertEqual(place['rating_count'], rated['count'])
+        if rated['avg'] is None:
+            self.assertIsNone(place['rating_avg'])
+        else:
+            self.assertAlmostEqual(place['rating_avg'], rated['avg'])
+
+    def test_counters(self):
+        self.assertCountersMatchVisits()
+        steps = [
+            ('ala', 'post', 0),
+            ('ola', 'post', 4),
+            ('ela', 'post', 2),
+            ('ola', 'put', 3),
+            ('ala', 'patch', 1),
+            ('ela', 'put', 0),
+            ('ola', 'delete', None),
+            ('ela', 'delete', None),
+            ('ala', 'delete', None),
+        ]
+        for username, method, rating in steps:
+            self.visit(username, method, rating)
+            self.assertCountersMatchVisits()
@@ -9,9 +9,14 @@ from . import views, views_login
 router = HybridRouter()
 router.register(r'token', views_login.LoginToken, base_name='token')
 router.add_api_view('me', url(r'^me/$', views.CurrentUserView.as_view(), name='me'))
+router.add_api_view('feed', url(r'^me/feed/$', views.FeedView.as_view(), name='feed'))
+router.add_api_view('sync', url(r'^sync/$', views.SyncView.as_view(), name='sync'))
+router.add_api_view('token-cache', url(r'^token-cache/$', views.TokenCacheStatsView.as_view(), name='token-cache'))
+router.add_api_view('provider-stats', url(r'^provider-stats/$', views.ProviderStatsView.as_view(), name='provider-stats'))
 router.register(r'users', views.UserViewSet)
 router.register(r'places', views.PlaceViewSet)
 router.register(r'tags', views.TagViewSet)
+router.register(r'photos', views.PhotoViewSet)
 
 urlpatterns = [
     url(r'^', include(router.urls)),
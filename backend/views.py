@@ -1,28 +1,59 @@
+import six
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import FileResponse, StreamingHttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.six.moves.urllib.parse import urlparse
 from rest_framework import exceptions
-from rest_framework.decorators import detail_route
-from rest_framework.parsers import FileUploadParser
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.generics import ListAPIView
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework.views import APIView
 from rest_framework.viewsets import ReadOnlyModelViewSet, ModelViewSet
 
-from backend.models import Place, Tag, Photo, Visit
+from backend.authentication import token_cache
+from backend.clusters import get_clusters
+from backend.conditional import ConditionalGetMixin
+from backend.feed import update_place_score
+from backend.filters import FeedLocationFilter, PlaceLocationFilter, PlaceSearchFilter, PlaceTagFilter, parse_bbox, \
+    filter_in_bbox
+from backend.http_client import provider_stats
+from backend.markers import marker_columns
+from backend.models import FeedEntry, Place, Tag, Photo, Visit, PHOTO_READY
+from backend.offline import cached_pack, caching_pack_chunks, pack_chunks, pack_region, pack_version
+from backend.pagination import FeedPagination, PlacePagination, TagPagination
+from backend.parsers import HashingFileUploadParser
+from backend.photo_cache import PHOTO_SIZES, PHOTO_TYPES, get_variant
+from backend.renderers import BinaryMarkerRenderer, GeoJSONMarkerRenderer
+from backend.search import search_words
+from backend.sync import decode_token, sync_data
 from backend.permissions import IsSelfOrReadOnly
-from .serializers import UserSerializer, PlaceSerializer, TagSerializer, VisitSerializer
+from .serializers import UserSerializer, PlaceSerializer, TagSerializer, VisitSerializer, PhotoDetailSerializer, \
+    field_requested
 
 
-class UserViewSet(ModelViewSet):
+class UserViewSet(ConditionalGetMixin, ModelViewSet):
     """
     This endpoint lists all users registered in the system
 
     TODO: in the final version, the full list of users will not be accessible
+
+    ---
+
+    **?fields=username,first_name** returns only the listed fields, **?expand=followed_tags** returns the full
+    followed tags instead of their names.
     """
 
-    queryset = User.objects.all()
+    queryset = User.objects.select_related('userprofile')
     serializer_class = UserSerializer
     permission_classes = (IsSelfOrReadOnly,)
+    last_modified_field = 'userprofile__date_modified'
+    expanded_last_modified_fields = {'followed_tags': 'userprofile__followed_tags__date_modified'}
 
     def perform_update(self, serializer):
         user = serializer.save()
@@ -55,26 +86,328 @@ class CurrentUserView(APIView):
         return response
 
 
-class PlaceViewSet(ModelViewSet):
+class TokenCacheStatsView(APIView):
+    """
+    This endpoint shows how well the token authentication cache of the process serving the request works.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(token_cache.stats())
+
+
+class ProviderStatsView(APIView):
+    """
+    This endpoint shows the latency and errors of requests to the OAuth providers made by the process serving
+    the request, and the state of their circuit breakers.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(provider_stats())
+
+
+class SyncView(APIView):
+    """
+    This endpoint returns what changed since the last sync, for keeping an offline copy of the data current.
+
+    ---
+
+    Without parameters everything is returned. Pass the **sync_token** of the previous response in **?since=**
+    to get only the places, photos, tags and visits that changed after it, and the urls of the ones deleted
+    in **deleted**. Apply the deletions first. **saved_places** lists all saved places when they changed, otherwise
+    it's null.
+
+    If **reset** is true, the token was too old and everything is returned, so the offline copy has to be
+    replaced.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        since = request.query_params.get('since')
+        return Response(sync_data(request, decode_token(since) if since else None))
+
+
+class FeedView(ListAPIView):
+    """
+    This endpoint lists places with the tags followed by the current user or their subtags, newest and best rated
+    first.
+
+    ---
+
+    **?near=lat,lng** ranks closer places higher too.
+
+    Results are paginated, follow the **next** link to get more of them.
+    """
+
+    serializer_class = PlaceSerializer
+    filter_backends = (FeedLocationFilter,)
+    pagination_class = FeedPagination
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        # The feed is maintained by backend.feed, so this is a single range scan over the user's entries
+        queryset = FeedEntry.objects.filter(user=self.request.user).select_related('place')
+        if field_requested(self.request, 'visit'):
+            queryset = queryset.prefetch_related(
+                Prefetch('place__visits', queryset=Visit.objects.filter(visitor=self.request.user), to_attr='user_visits'),
+            )
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        entries = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        serializer = self.get_serializer([entry.place for entry in entries], many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """
+    For views which don't return a rendered response, so the Accept header doesn't have to match any renderer
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+
+def place_pk_from_url(url):
+    try:
+        match = resolve(urlparse(url).path)
+    except (Resolver404, AttributeError, TypeError):
+        return None
+    if match.url_name != 'place-detail':
+        return None
+    try:
+        return int(match.kwargs['pk'])
+    except (KeyError, ValueError):
+        return None
+
+
+class PlaceViewSet(ConditionalGetMixin, ModelViewSet):
+    """
+    This endpoint lists all places
+
+    ---
+
+    The list can be limited to a part of the map:
+
+    * **?in_bbox=lat1,lng1,lat2,lng2** returns places inside the box from its western corner eastwards to the other
+      one, so it crosses the antimeridian when lng1 &gt; lng2
+    * **?near=lat,lng&radius=meters** returns places within the given distance from a point
+    * **?near=lat,lng&ordering=distance** returns the closest places first
+
+    **?tag=&lt;name&gt;** returns places with the tag or any of its subtags. Repeat it to require multiple tags.
+
+    **?q=&lt;words&gt;** searches the names and descriptions, best matches first. Words match as prefixes.
+
+    Results are paginated, follow the **next** link to get more of them. Use **?page_size=** to change the size
+    of a page (at most 500).
+
+    **POST /places/batch/** takes a list of places and creates them all at once, or updates those that
+    include the url of an existing place. If any of them is invalid nothing is saved, and the response lists
+    the errors of each place.
+
+    **/places/markers/** returns just the id, name and coordinates of all the matching places (not paginated), as
+    parallel lists: {"id": [...], "name": [...], "lat": [...], "lng": [...]}. **?top_tag=true** adds the most used
+    tag of each place. **?format=geojson** returns a GeoJSON FeatureCollection instead, and **?format=bin**
+    the binary layout described in backend.markers.markers_binary.
+
+    **/places/offline/** downloads the matching places and their photos as a zip for offline use. It needs
+    **in_bbox** or **tag**, and can be narrowed down with **q**, other filters don't apply. **?size=** (thumb,
+    medium or large, medium by default) and **?type=** (jpeg or webp, jpeg by default) choose the photo variants.
+    Packs always have all the fields of the places.
+
+    Zoomed out maps should use **/places/clusters/?zoom=&lt;map zoom&gt;&bbox=lat1,lng1,lat2,lng2** instead.
+
+    **?fields=name,coords** returns only the listed fields, and **?expand=author,tags** returns the full author
+    and tags instead of their urls and names. Fields that aren't returned aren't computed at all.
+
+    Responses have an ETag, send it back in If-None-Match to get a 304 Not Modified if nothing changed. Single
+    places also have a Last-Modified for If-Modified-Since.
+    """
+
     # TODO: permissions
     queryset = Place.objects.all()
+    max_batch_size = 500
     serializer_class = PlaceSerializer
+    filter_backends = (PlaceSearchFilter, PlaceLocationFilter, PlaceTagFilter)
+    pagination_class = PlacePagination
+    # The profile is bumped by any change of its user
+    expanded_last_modified_fields = {'author': 'author__userprofile__date_modified', 'tags': 'tags__date_modified'}
 
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
+    def get_queryset(self):
+        """
+        Fetch the visits of the user up front, so that listing places takes a constant number of queries.
+        The rest is only needed for places missing from the cache, see backend.fragments
+        """
+        queryset = super(PlaceViewSet, self).get_queryset()
+        prefetch = self.user_visits_prefetch()
+        if prefetch is not None:
+            queryset = queryset.prefetch_related(prefetch)
+        return queryset
+
+    def user_visits_prefetch(self):
+        if self.request.user.is_authenticated() and field_requested(self.request, 'visit'):
+            return Prefetch('visits', queryset=Visit.objects.filter(visitor=self.request.user), to_attr='user_visits')
+        return None
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
-    @detail_route(methods=['post'], parser_classes=[FileUploadParser])
+    def perform_update(self, serializer):
+        instance = serializer.save()
+        # The tags could have changed after they were prefetched
+        instance._prefetched_objects_cache = {}
+
+    @list_route(methods=['post'])
+    def batch(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            raise exceptions.ParseError('Expected a list of places.')
+        if len(items) > self.max_batch_size:
+            raise exceptions.ParseError('At most %d places can be sent at once.' % self.max_batch_size)
+
+        # All the tags and places referenced by the batch are fetched up front
+        names = set()
+        for item in items:
+            tags = item.get('tags') if isinstance(item, dict) else None
+            if isinstance(tags, list):
+                names.update(name for name in tags if isinstance(name, six.string_types))
+        context = self.get_serializer_context()
+        context['tags_by_name'] = dict((tag.name, tag) for tag in Tag.objects.filter(name__in=names))
+        pks = [place_pk_from_url(item.get('url')) if isinstance(item, dict) else None for item in items]
+        existing = Place.objects.in_bulk([pk for pk in pks if pk is not None])
+
+        errors = [{} for _ in items]
+        new_indexes = [i for i, item in enumerate(items) if not isinstance(item, dict) or 'url' not in item]
+        new_places = PlaceSerializer(data=[items[i] for i in new_indexes], many=True, context=context)
+        if not new_places.is_valid():
+            for i, item_errors in zip(new_indexes, new_places.errors):
+                errors[i] = item_errors
+
+        updated_places = {}
+        for i, (item, pk) in enumerate(zip(items, pks)):
+            if i in new_indexes:
+                continue
+            if pk not in existing:
+                errors[i] = {'url': ['Unknown place.']}
+                continue
+            updated_places[i] = PlaceSerializer(existing[pk], data=item, partial=True, context=context)
+            if not updated_places[i].is_valid():
+                errors[i] = updated_places[i].errors
+
+        if any(errors):
+            return Response(errors, status=400)
+
+        places = [None] * len(items)
+        with transaction.atomic():
+            for i, place in zip(new_indexes, new_places.save(author=request.user)):
+                places[i] = place
+            for i, serializer in updated_places.items():
+                places[i] = serializer.save()
+
+        # Neither in_bulk() nor the new places went through get_queryset()
+        prefetch = self.user_visits_prefetch()
+        if prefetch is not None:
+            prefetch_related_objects(places, prefetch)
+        return Response(PlaceSerializer(places, many=True, context=context).data, status=201)
+
+    @list_route(methods=['get'], renderer_classes=[JSONRenderer, GeoJSONMarkerRenderer, BinaryMarkerRenderer])
+    def markers(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(request, queryset, self.markers_response, queryset)
+
+    def markers_response(self, request, queryset):
+        top_tag = request.query_params.get('top_tag') in ('1', 'true')
+        return Response(marker_columns(queryset, top_tag=top_tag))
+
+    @list_route(methods=['get'], content_negotiation_class=IgnoreClientContentNegotiation)
+    def offline(self, request):
+        bbox = parse_bbox(request, 'in_bbox')
+        tags = request.query_params.getlist('tag')
+        if bbox is None and not tags:
+            raise exceptions.ParseError('in_bbox or tag is required')
+        size = request.query_params.get('size', 'medium')
+        if size not in PHOTO_SIZES:
+            raise exceptions.ParseError('size should be one of: ' + ', '.join(PHOTO_SIZES))
+        image_type = request.query_params.get('type', 'jpeg')
+        if image_type not in PHOTO_TYPES:
+            raise exceptions.ParseError('type should be one of: ' + ', '.join(PHOTO_TYPES))
+
+        # Only the parameters that are part of pack_region() choose the places
+        queryset = self.get_queryset()
+        if bbox is not None:
+            queryset = filter_in_bbox(queryset, bbox)
+        for backend in (PlaceTagFilter, PlaceSearchFilter):
+            queryset = backend().filter_queryset(request, queryset, self)
+        queryset = queryset.order_by('pk')
+
+        region = pack_region(request, bbox, tags, search_words(request.query_params.get('q')), size, image_type)
+        return self.conditional_response(request, queryset, self.offline_response, queryset, region, size, image_type)
+
+    def offline_response(self, request, queryset, region, size, image_type):
+        version = pack_version(queryset)
+        pack = cached_pack(region, version)
+        if pack is not None:
+            response = FileResponse(pack, content_type='application/zip')
+        else:
+            chunks = caching_pack_chunks(pack_chunks(request, queryset, size, image_type), region, version)
+            response = StreamingHttpResponse(chunks, content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="places.zip"'
+        return response
+
+    @list_route(methods=['get'])
+    def clusters(self, request):
+        try:
+            zoom = int(request.query_params['zoom'])
+        except (KeyError, ValueError):
+            raise exceptions.ParseError('zoom should be an integer')
+
+        clusters = get_clusters(zoom, parse_bbox(request, 'bbox')).values_list('count', 'lat_sum', 'lng_sum', 'place_id')
+        return Response([{
+            'coords': [lat_sum / count, lng_sum / count],
+            'count': count,
+            'place': place_id,
+        } for count, lat_sum, lng_sum, place_id in clusters])
+
+    @detail_route(methods=['post'], parser_classes=[HashingFileUploadParser])
     def photo_upload(self, request, pk=None):
-        photo = Photo()
-        photo.photo = request.data['file']
-        photo.place = self.get_object()
-        photo.save()
+        upload = request.data['file']
+        place = self.get_object()
+
+        # Clients retrying an upload shouldn't end up with the same photo twice
+        photo = Photo.objects.filter(place=place, sha256=upload.sha256).first()
+        if photo is not None:
+            return self.photo_upload_response(request, photo, status=200)
+
+        photo = Photo(place=place, sha256=upload.sha256)
+        photo.photo = upload
+        try:
+            with transaction.atomic():
+                photo.save()
+        except IntegrityError:
+            # The same photo was uploaded concurrently
+            photo.photo.delete(save=False)
+            photo = Photo.objects.get(place=place, sha256=upload.sha256)
+            return self.photo_upload_response(request, photo, status=200)
+        return self.photo_upload_response(request, photo, status=202)
+
+    def photo_upload_response(self, request, photo, status):
+        # The resized variation is rendered in the background, check the status url to see when it's ready
         return Response({
+            'id': photo.pk,
+            'status': photo.status,
+            'status_url': reverse('photo-detail', args=[photo.pk], request=request),
             'url': request.build_absolute_uri(photo.photo.url),
-            'resized_url': request.build_absolute_uri(photo.photo.resized.url)
-        })
+            'resized_url': request.build_absolute_uri(photo.photo.resized.url) if photo.status == PHOTO_READY else None,
+        }, status=status)
 
     @detail_route(methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'], serializer_class=VisitSerializer)
     def visit(self, request, pk=None):
@@ -90,10 +423,18 @@ class PlaceViewSet(ModelViewSet):
         serializer = VisitSerializer(instance, data=request.data, partial=(request.method == 'PATCH'), context={'request': request})
         serializer.is_valid(raise_exception=True)
         if request.method != 'GET':
-            serializer.save(place_id=pk, visitor=request.user)
+            with transaction.atomic():
+                old_rating = instance.rating if instance else None
+                visit = serializer.save(place_id=pk, visitor=request.user)
+                new_rating = visit.rating
 
-        if request.method == 'DELETE':
-            instance.delete()
+                if request.method == 'DELETE':
+                    instance.delete()
+                    new_rating = None
+
+                Place.objects.filter(pk=pk).update(**Place.counter_updates(old_rating, new_rating))
+                if old_rating != new_rating:
+                    update_place_score(pk)
 
         return Response(serializer.data)
 
@@ -109,6 +450,46 @@ class PlaceViewSet(ModelViewSet):
         return Response(request.user.userprofile.saved_places.filter(pk=instance.pk).exists())
 
 
-class TagViewSet(ReadOnlyModelViewSet):
-    queryset = Tag.objects.all()
+class PhotoViewSet(ReadOnlyModelViewSet):
+    """
+    This endpoint shows the processing status of uploaded photos. The resized variation is available once
+    the status becomes **ready**.
+
+    ---
+
+    Smaller versions of a ready photo can be downloaded from **/photos/&lt;id&gt;/variant/?size=&lt;size&gt;**,
+    where size is one of **thumb**, **medium** or **large**. Add **&type=jpeg** or **&type=webp** to choose the format,
+    otherwise WebP is returned if the Accept header allows it.
+    """
+
+    queryset = Photo.objects.all()
+    serializer_class = PhotoDetailSerializer
+
+    @detail_route(methods=['get'], content_negotiation_class=IgnoreClientContentNegotiation)
+    def variant(self, request, pk=None):
+        photo = self.get_object()
+        if photo.status != PHOTO_READY:
+            raise exceptions.NotFound('The photo is still being processed.')
+
+        size = request.query_params.get('size')
+        if size not in PHOTO_SIZES:
+            raise exceptions.ParseError('size should be one of: ' + ', '.join(PHOTO_SIZES))
+
+        image_type = request.query_params.get('type')
+        if image_type is None:
+            image_type = 'webp' if 'image/webp' in request.META.get('HTTP_ACCEPT', '') else 'jpeg'
+        elif image_type not in PHOTO_TYPES:
+            raise exceptions.ParseError('type should be one of: ' + ', '.join(PHOTO_TYPES))
+
+        response = FileResponse(get_variant(photo, size, image_type), content_type=PHOTO_TYPES[image_type][1])
+        # Photos never change once they are processed
+        response['Cache-Control'] = 'public, max-age=31536000'
+        if 'type' not in request.query_params:
+            response['Vary'] = 'Accept'
+        return response
+
+
+class TagViewSet(ConditionalGetMixin, ReadOnlyModelViewSet):
+    queryset = Tag.objects.select_related('parent')
     serializer_class = TagSerializer
+    pagination_class = TagPagination
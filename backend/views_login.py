@@ -15,6 +15,9 @@ from rest_framework.exceptions import NotAuthenticated, AuthenticationFailed
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
+from backend.google_auth import verify_id_token, InvalidToken, KeysUnavailable
+from backend.http_client import PooledOAuth2Client
+
 # Google:
 # auth url: https://accounts.google.com/o/oauth2/auth
 # token url: https://accounts.google.com/o/oauth2/token
@@ -42,6 +45,12 @@ class LoginRedirect(OAuthRedirect):
 
 
 class LoginCallback(OAuthCallback):
+    def get_client(self, provider):
+        if provider.request_token_url:
+            # OAuth 1.0, none of the providers we use
+            return super(LoginCallback, self).get_client(provider)
+        return PooledOAuth2Client(provider)
+
     def get_or_create_user(self, provider, access, info):
         logger.info(info)
 
@@ -131,15 +140,12 @@ class LoginToken(LoginCallback, ViewSet):
                     return self.handle_login_failure(provider, "Could not retrieve token.")
                 id_token = request.GET['token']
                 try:
-                    response = client.request('get', 'https://www.googleapis.com/oauth2/v3/tokeninfo', params={'id_token': id_token})
-                    response.raise_for_status()
-                except RequestException as e:
-                    logger.error('Unable to validate access token: {0}'.format(e))
-                    return self.handle_login_failure(provider, "Could not validate token.")
-                else:
-                    info = json.loads(response.text)
-                if info['aud'] != provider.consumer_key:
-                    return self.handle_login_failure(provider, "This token is not meant for this app. %s != %s" % (info['aud'], provider.consumer_key))
+                    info = verify_id_token(id_token, provider.consumer_key)
+                except InvalidToken as e:
+                    return self.handle_login_failure(provider, force_text(e))
+                except KeysUnavailable as e:
+                    logger.warning('{0}, validating the token with Google'.format(e))
+                    info = self.get_google_token_info(provider, client, id_token)
                 identifier = info['id'] = info['sub']
                 del info['sub']
             else:
@@ -161,6 +167,18 @@ class LoginToken(LoginCallback, ViewSet):
             else:
                 return self.handle_existing_user(provider, user, access, info)
 
+    def get_google_token_info(self, provider, client, id_token):
+        try:
+            response = client.request('get', 'https://www.googleapis.com/oauth2/v3/tokeninfo', params={'id_token': id_token})
+            response.raise_for_status()
+        except RequestException as e:
+            logger.error('Unable to validate access token: {0}'.format(e))
+            return self.handle_login_failure(provider, "Could not validate token.")
+        info = json.loads(response.text)
+        if info['aud'] != provider.consumer_key:
+            return self.handle_login_failure(provider, "This token is not meant for this app. %s != %s" % (info['aud'], provider.consumer_key))
+        return info
+
     def handle_existing_user(self, provider, user, access, info):
         super(LoginToken, self).handle_existing_user(provider, user, access, info)
         return self.handle_token_response(provider.name, access.user)
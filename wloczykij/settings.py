@@ -53,6 +53,7 @@ AUTHENTICATION_BACKENDS = (
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'backend.db.routers.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -90,11 +91,55 @@ WSGI_APPLICATION = 'wloczykij.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+        # SpatiaLite in WAL mode, waiting for and retrying locked writes, see backend.db.spatialite.base
+        # for the defaults of the options
+        'ENGINE': 'backend.db.spatialite',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Connections are kept between requests, so SpatiaLite isn't loaded every time
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            'pragmas': {'busy_timeout': 5000},
+            'lock_retries': 5,
+        },
     }
 }
 
+# Reads of GET requests go to these copies of the primary database, see backend.db.routers. To try it locally,
+# copy db.sqlite3 to replica.sqlite3 and add it to DATABASES as 'replica', like 'default' but with that NAME
+# and 'TEST': {'MIRROR': 'default'}, then list it here. Clients that wrote read from the primary for
+# REPLICA_PIN_SECONDS, set REPLICA_PIN_CACHE_ALIAS to a cache shared by all processes when running more than one.
+DATABASE_ROUTERS = ['backend.db.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+# 'round-robin' or 'least-lag', which skips replicas more than REPLICA_MAX_LAG seconds behind the primary,
+# checking every REPLICA_LAG_CHECK_INTERVAL seconds. The lag is measured with a heartbeat, 'least-lag' needs
+# manage.py replication_heartbeat running, writing one every REPLICA_HEARTBEAT_INTERVAL seconds, otherwise all
+# reads go to the primary.
+REPLICA_SELECTION = 'round-robin'
+REPLICA_MAX_LAG = 5
+REPLICA_LAG_CHECK_INTERVAL = 10
+REPLICA_HEARTBEAT_INTERVAL = 1
+REPLICA_PIN_SECONDS = 10
+REPLICA_PIN_CACHE_ALIAS = 'default'
+
+
+# Caches
+# https://docs.djangoproject.com/en/1.10/ref/settings/#caches
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Place representations, see PLACE_CACHE_ALIAS. Each process keeps its own, big enough for every place of a
+    # large region, switch it to a shared backend like memcached when running more than one.
+    'places': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'places',
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -141,10 +186,17 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         #'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
-    )
+        'backend.authentication.CachedTokenAuthentication',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'backend.pagination.KeysetPagination',
 }
 
+# Authenticated tokens are remembered for this many seconds, see backend.authentication.TokenCache.
+# Set TOKEN_CACHE_ALIAS to one of CACHES to share them between processes instead of keeping them in each one.
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_MAX_SIZE = 10000
+TOKEN_CACHE_ALIAS = None
+
 
 LOGGING = {
     'version': 1,
@@ -176,4 +228,37 @@ LOGGING = {
 SPATIALITE_LIBRARY_PATH = 'mod_spatialite'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'uploads')
-MEDIA_URL = '/uploads/'
\ No newline at end of file
+MEDIA_URL = '/uploads/'
+
+# Photo variants rendered on demand, the least recently used ones are removed once the cache grows over the limit
+PHOTO_CACHE_ROOT = os.path.join(BASE_DIR, 'photo_cache')
+PHOTO_CACHE_MAX_SIZE = 512 * 1024 * 1024
+# Offline packs of places and photos, kept until a newer version of the same pack is made, the least recently used
+# ones are removed once they take more than the limit, see backend.offline
+OFFLINE_PACK_ROOT = os.path.join(BASE_DIR, 'offline_packs')
+OFFLINE_PACK_MAX_SIZE = 2 * 1024 * 1024 * 1024
+# Full-text index of places used by ?q=, see backend.search
+SEARCH_BACKEND = 'backend.search.SQLiteSearchBackend'
+
+# Requests to OAuth providers, see backend.http_client: (connect, read) timeouts in seconds, retries of failed
+# GET requests, connections kept open per provider, and the circuit breaker failing logins right away for
+# OAUTH_CIRCUIT_RESET_TIMEOUT seconds after OAUTH_CIRCUIT_THRESHOLD failures in a row
+OAUTH_HTTP_TIMEOUT = (3.05, 10)
+OAUTH_HTTP_RETRIES = 2
+OAUTH_HTTP_POOL_SIZE = 10
+OAUTH_CIRCUIT_THRESHOLD = 5
+OAUTH_CIRCUIT_RESET_TIMEOUT = 30
+
+# Where the keys for verifying Google ID tokens come from, see backend.google_auth: a class or factory, called with
+# GOOGLE_KEY_SOURCE_OPTIONS, e.g. 'backend.google_auth.StaticKeySource' with {'keys': {kid: PEM of the key}}
+GOOGLE_KEY_SOURCE = 'backend.google_auth.GoogleKeySource'
+GOOGLE_KEY_SOURCE_OPTIONS = {}
+
+# The parts of place representations shared by all users are cached for this many seconds, see backend.fragments
+PLACE_CACHE_ALIAS = 'places'
+PLACE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# The delta sync repeats the changes of the last SYNC_OVERLAP seconds, in case they were committed late, and
+# remembers deleted objects for SYNC_TOMBSTONE_DAYS, older sync tokens start over, see backend.sync
+SYNC_OVERLAP = 5
+SYNC_TOMBSTONE_DAYS = 30